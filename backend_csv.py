@@ -1,5 +1,9 @@
 import csv
+import hashlib
 import os
+import shutil
+from fileutil import atomicWrite
+from metrics import metrics
 from models import *
 
 class Backend:
@@ -10,7 +14,29 @@ class Backend:
         return self.config.get('csv', name)
 
     def getPersonList(self):
-        with open(self.get_setting('PEOPLE_FILE'), "rt") as f:
+        return self.getPersonListIfChanged(None)[0]
+
+    @metrics.timed("backend_get_person_list_seconds")
+    def getPersonListIfChanged(self, version):
+        """Read the person list unless the people file is unchanged since
+        version (as returned by a previous call).  Returns (people or None
+        if unchanged, new version)."""
+        if not isinstance(version, tuple):
+            version = None
+        filename = self.get_setting('PEOPLE_FILE')
+        st = os.stat(filename)
+        if version is not None and \
+                version[:2] == (st.st_mtime, st.st_size):
+            return None, version
+        with open(filename, "rb") as f:
+            data = f.read()
+        metrics.count("backend_bytes_received_total", len(data))
+        digest = hashlib.sha1(data).hexdigest()
+        newVersion = (st.st_mtime, st.st_size, digest)
+        if version is not None and version[2] == digest:
+            return None, newVersion
+
+        with open(filename, "rt") as f:
             people = []
             for row in csv.DictReader(f):
                 id = int(row["ID"])
@@ -24,27 +50,41 @@ class Backend:
                 except OSError:
                     photoSize = 0
                 people.append(Person(id, name, student, photoPath, photoSize, id))
-            return people
+            return people, newVersion
 
+    def photoVersion(self, photoPath):
+        """Size and mtime of the source photo (None if it is missing), so
+        a photo replaced on disk is noticed without people.csv changing
+        and without reading the photo."""
+        try:
+            st = os.stat(photoPath)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    @metrics.timed("backend_get_badge_photo_seconds")
     def getBadgePhoto(self, photoPath, localName):
         # Avoid copy if both are the same file
         if os.path.abspath(photoPath) == os.path.abspath(localName):
             return
-        with open(photoPath, "rb") as f:
-            data = f.read()
-        with open(localPath, "wb") as f:
-            f.write(data)
+        with open(photoPath, "rb") as src:
+            with atomicWrite(localName) as dst:
+                shutil.copyfileobj(src, dst)
+                metrics.count("backend_bytes_received_total", dst.tell())
 
+    @metrics.timed("backend_put_time_records_seconds")
     def putTimeRecords(self, records):
         if not records:
             return set() # no records to put
 
         with open(self.get_setting('RECORDS_FILE'), "a") as f:
+            start = f.tell()
             writer = csv.writer(f)
             for record in records:
                 writer.writerow([record.person.id, record.person.name,
                         record.person.student, "", record.inTime,
                         record.outTime, record.hours, record.recorded])
+            metrics.count("backend_bytes_sent_total", f.tell() - start)
 
             # report all as successfully added
             return set(i for i, v in enumerate(records))
@@ -5,106 +5,281 @@ try:
 except ImportError:
     import urlparse
 try:
-    from urllib.request import (urlretrieve, HTTPCookieProcessor, build_opener,
-            Request)
+    from urllib.request import HTTPCookieProcessor, build_opener, Request
+    from urllib.error import HTTPError
 except ImportError:
-    from urllib import urlretrieve
-    from urllib2 import HTTPCookieProcessor, build_opener, Request
+    from urllib2 import HTTPCookieProcessor, build_opener, Request, HTTPError
 import io
 import csv
+import gzip
+import hashlib
+import shutil
+import threading
+from contextlib import closing
+from fileutil import atomicWrite
+from metrics import metrics
 from models import *
 
+# Response to a compressed upload meaning the server doesn't accept it
+UNSUPPORTED_MEDIA_TYPE = 415
+
+class TrackingReader(io.RawIOBase):
+    """Passes reads through from f, counting the bytes read (and keeping
+    their SHA1 digest if digest is True)."""
+
+    def __init__(self, f, digest=False):
+        self.f = f
+        self.size = 0
+        self.sha1 = hashlib.sha1() if digest else None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.f.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.size += n
+        if self.sha1 is not None:
+            self.sha1.update(data)
+        return n
+
 class Backend:
     def __init__(self, config):
         self.config = config
+        self.loginLock = threading.Lock()
+        # cleared if the server turns out not to accept gzipped uploads
+        self.compressUploads = config.getboolean('roster', 'COMPRESS')
+        self.newSession()
 
     def get_setting(self, name):
         return self.config.get('roster', name)
 
     def setPassword(self, password):
         self.config.set('roster', 'LOGIN_PASSWORD', password)
+        self.newSession()
 
-    def login(self, loc=None):
-        if loc is None:
-            loc = self.get_setting('BASE_LOCATION')
-        login_url = self.get_setting('BASE_URL') + \
-                self.get_setting('LOGIN_LOCATION')
-        cookies = HTTPCookieProcessor()
-        opener = build_opener(cookies)
-        opener.open(login_url)
+    def newSession(self):
+        """Start a new (not logged in) session.  The cookie jar, and so the
+        login, is shared by all requests made through open()."""
+        with self.loginLock:
+            self.cookies = HTTPCookieProcessor()
+            self.opener = build_opener(self.cookies)
+            self.logins = 0 # incremented on each successful login
 
-        try:
-            token = [x.value for x in cookies.cookiejar if x.name == 'csrftoken'][0]
-        except IndexError:
-            raise IOError("No csrf cookie found")
-
-        params = dict(username=self.get_setting('LOGIN_USERNAME'),
-                password=self.get_setting('LOGIN_PASSWORD'),
-                next=loc,
-                csrfmiddlewaretoken=token)
-        encoded_params = urlparse.urlencode(params).encode('utf-8')
-
-        req = Request(login_url, encoded_params)
-        req.add_header('Referer', login_url)
-        response = opener.open(req)
-        if response.geturl() == login_url:
-            raise IOError("Authentication refused")
-        return opener, response
+    def isLoginPage(self, url):
+        login_path = urlparse.urlsplit(self.get_setting('LOGIN_LOCATION')).path
+        return urlparse.urlsplit(url).path == login_path
+
+    @metrics.timed("backend_login_seconds")
+    def login(self, generation, loc=None, headers=None):
+        """Log in to the server, unless another thread already did so since
+        the caller saw self.logins == generation.  If loc is given, returns
+        the response for it (the server redirects there after login,
+        and the request for it is sent with headers); otherwise returns
+        None."""
+        with self.loginLock:
+            if self.logins != generation:
+                return None
+            login_url = self.get_setting('BASE_URL') + \
+                    self.get_setting('LOGIN_LOCATION')
+            self.opener.open(login_url).close()
+
+            try:
+                token = [x.value for x in self.cookies.cookiejar
+                        if x.name == 'csrftoken'][0]
+            except IndexError:
+                raise IOError("No csrf cookie found")
+
+            params = dict(username=self.get_setting('LOGIN_USERNAME'),
+                    password=self.get_setting('LOGIN_PASSWORD'),
+                    next=loc or self.get_setting('BASE_LOCATION'),
+                    csrfmiddlewaretoken=token)
+            encoded_params = urlparse.urlencode(params).encode('utf-8')
+
+            req = Request(login_url, encoded_params)
+            req.add_header('Referer', login_url)
+            if loc is not None:
+                # passed on to the redirect to loc
+                for name, value in (headers or {}).items():
+                    req.add_header(name, value)
+            try:
+                response = self.opener.open(req)
+            except HTTPError as e:
+                # e.g. 304 Not Modified for loc, so logged in
+                if not self.isLoginPage(e.geturl()):
+                    self.logins += 1
+                raise
+            if self.isLoginPage(response.geturl()):
+                response.close()
+                raise IOError("Authentication refused")
+            self.logins += 1
+            if loc is None:
+                response.close()
+                return None
+            return response
+
+    def open(self, loc, data=None, headers=None):
+        """Open loc on the shared session.  Logs in first if needed, and
+        again if the server redirects to the login page (session
+        expired)."""
+        generation = self.logins
+        if generation == 0 and data is None:
+            # fetch loc as part of the login
+            response = self.login(generation, loc, headers)
+            if response is not None:
+                return response
+        elif generation == 0:
+            self.login(generation)
+        generation = self.logins
+
+        url = self.get_setting('BASE_URL') + loc
+        response = self.opener.open(Request(url, data, headers or {}))
+        if self.isLoginPage(response.geturl()):
+            response.close()
+            self.login(generation)
+            # a new request: the first carries the old session's cookie,
+            # which the cookie processor wouldn't replace
+            response = self.opener.open(Request(url, data, headers or {}))
+            if self.isLoginPage(response.geturl()):
+                response.close()
+                raise IOError("Authentication refused")
+        return response
 
     def fetchWithLogin(self, loc):
-        return self.login(loc)[1].read()
+        with closing(self.open(loc)) as response:
+            return response.read()
 
     def getPersonList(self):
-        data = self.fetchWithLogin(self.get_setting('SIGNIN_PERSON_LIST_LOCATION')).decode('utf-8')
-        people = []
-        for row in csv.DictReader(io.StringIO(data, newline="")):
-            id = int(row["id"])
-            name = row["name"]
-            student = (row["student"] != "False")
-            photoPath = row["photo"]
-            photoSize = int(row["photo size"])
-            badge = int(row["badge"])
-            people.append(Person(id, name, student, photoPath, photoSize, badge))
-        return people
+        return self.getPersonListIfChanged(None)[0]
 
+    @metrics.timed("backend_get_person_list_seconds")
+    def getPersonListIfChanged(self, version):
+        """Fetch the person list unless it is unchanged since version (as
+        returned by a previous call).  Returns (people or None if
+        unchanged, new version).  Uses a conditional GET, falling back to
+        comparing a digest of the content if the server doesn't support
+        it."""
+        if not isinstance(version, dict):
+            version = {}
+        headers = {}
+        if self.config.getboolean('roster', 'COMPRESS'):
+            headers['Accept-Encoding'] = 'gzip'
+        if version.get('etag'):
+            headers['If-None-Match'] = version['etag']
+        if version.get('modified'):
+            headers['If-Modified-Since'] = version['modified']
+        try:
+            response = self.open(
+                    self.get_setting('SIGNIN_PERSON_LIST_LOCATION'),
+                    headers=headers)
+        except HTTPError as e:
+            if e.code == 304:
+                return None, version
+            raise
+        with closing(response):
+            # decompress and parse as the response arrives; the digest is
+            # of the (decompressed) content
+            received = TrackingReader(response)
+            stream = io.BufferedReader(received)
+            if (response.info().get('Content-Encoding') or "").lower() \
+                    == 'gzip':
+                stream = gzip.GzipFile(fileobj=stream, mode='rb')
+            content = TrackingReader(stream, digest=True)
+            people = []
+            for row in csv.DictReader(io.TextIOWrapper(
+                    io.BufferedReader(content), encoding='utf-8',
+                    newline="")):
+                id = int(row["id"])
+                name = row["name"]
+                student = (row["student"] != "False")
+                photoPath = row["photo"]
+                photoSize = int(row["photo size"])
+                badge = int(row["badge"])
+                people.append(Person(id, name, student, photoPath, photoSize, badge))
+            metrics.count("backend_bytes_received_total", received.size)
+            newVersion = dict(etag=response.info().get('ETag'),
+                    modified=response.info().get('Last-Modified'),
+                    digest=content.sha1.hexdigest())
+        if newVersion['digest'] == version.get('digest'):
+            return None, newVersion
+        return people, newVersion
+
+    @metrics.timed("backend_get_badge_photo_seconds")
     def getBadgePhoto(self, photoPath, localName):
         print("downloading %s" % photoPath)
-        urlretrieve(self.get_setting('BASE_URL') + photoPath, localName)
+        with closing(self.open(photoPath)) as response:
+            with atomicWrite(localName) as f:
+                shutil.copyfileobj(response, f)
+                metrics.count("backend_bytes_received_total", f.tell())
 
-    def putTimeRecords(self, records):
-        """Send list of time records to server.  Returns set of indices of
-        accepted records."""
-        if not records:
-            return set() # no records to put
-
-        # build csv file to send
-        f = io.StringIO(newline='')
+    def encodeTimeRecords(self, records, compress):
+        """CSV of records to send to the server, gzipped if compress."""
+        body = io.BytesIO()
+        out = gzip.GzipFile(fileobj=body, mode='wb') if compress else body
+        f = io.TextIOWrapper(out, encoding='utf-8', newline="")
         writer = csv.writer(f)
         writer.writerow(['person', 'event', 'clock_in', 'clock_out', 'hours',
                 'recorded'])
         for record in records:
             writer.writerow([record.person.id, "", record.inTime,
                     record.outTime, record.hours, record.recorded])
+        f.flush()
+        f.detach()
+        if compress:
+            out.close()
+        return body.getvalue()
 
-        # send it
-        opener = self.login()[0]
-        url = self.get_setting('BASE_URL') + \
-                self.get_setting('TIME_RECORD_BULK_ADD_LOCATION')
-        data = f.getvalue().encode('utf-8')
+    def postTimeRecords(self, records, compress):
+        """Send records.  Returns (set of indices of accepted records,
+        error text from the server)."""
+        loc = self.get_setting('TIME_RECORD_BULK_ADD_LOCATION')
+        url = self.get_setting('BASE_URL') + loc
+        data = self.encodeTimeRecords(records, compress)
         clen = len(data)
-        req = Request(url, data,
-                {'Content-Type': 'text/csv', 'Content-Length': clen})
-        with opener.open(req) as response:
+        headers = {'Content-Type': 'text/csv', 'Content-Length': clen}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        metrics.count("backend_bytes_sent_total", clen)
+        response = self.open(loc, data, headers)
+        with closing(response):
             if response.geturl() != url:
-                raise IOError("Authentication refused")
+                raise IOError("Unexpected redirect to %s" % response.geturl())
             # response is a str() of a list, convert back into a real list
-            resp = response.read().decode('utf-8').strip()
+            resp = response.read()
+            metrics.count("backend_bytes_received_total", len(resp))
+            resp = resp.decode('utf-8').strip()
             ok, sep, errs = resp.partition('\n')
-            if errs:
-                print(errs)
             if ok == "[]": # handle empty list as the below doesn't
-                return set()
-            return set(int(x) for x in ok.strip("[]").split(','))
+                return set(), errs
+            return set(int(x) for x in ok.strip("[]").split(',')), errs
+
+    @metrics.timed("backend_put_time_records_seconds")
+    def putTimeRecords(self, records):
+        """Send list of time records to server.  Returns set of indices of
+        accepted records.  The upload is gzipped unless the server has
+        been found not to accept that."""
+        if not records:
+            return set() # no records to put
+
+        if self.compressUploads:
+            try:
+                ok, errs = self.postTimeRecords(records, True)
+                if errs:
+                    print(errs)
+                return ok
+            except HTTPError as e:
+                # anything else (e.g. a 500) is an ordinary failure
+                if e.code != UNSUPPORTED_MEDIA_TYPE:
+                    raise
+            print("Server does not accept compressed uploads")
+            metrics.count("backend_compression_fallbacks_total")
+            self.compressUploads = False
+
+        ok, errs = self.postTimeRecords(records, False)
+        if errs:
+            print(errs)
+        return ok
 
 if __name__ == "__main__":
     try:
@@ -117,7 +292,7 @@ if __name__ == "__main__":
 
     backend = Backend(config)
     backend.setPassword(getpass.getpass("Password: "))
-    people = list(backend.getPersonList())
+    people = backend.getPersonList()
     for person in people:
         print(person.name)
 
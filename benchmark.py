@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Benchmarks for DataStore, the csv backend and name search.
+
+Runs without a display or PyQt.  For each scale a synthetic
+people.csv roster and time log of that many people/records is generated in
+a scratch directory, and the results are written as JSON so that runs on
+different commits can be compared:
+
+    python benchmark.py -o before.json
+    python benchmark.py --scales 100,10000 --storage sqlite
+"""
+from __future__ import print_function
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import backend_csv
+import datastore
+from models import TimeRecord
+
+FIRST_NAMES = ["Alex", "Bailey", "Casey", "Dana", "Elliot", "Frankie",
+        "Gray", "Harper", "Indigo", "Jordan", "Kai", "Logan", "Morgan",
+        "Noel", "Oakley", "Parker", "Quinn", "Riley", "Sage", "Taylor"]
+LAST_NAMES = ["Anderson", "Brown", "Chen", "Davis", "Evans", "Garcia",
+        "Hughes", "Ito", "Johnson", "Kim", "Lopez", "Miller", "Nguyen",
+        "Okafor", "Patel", "Rossi", "Smith", "Tanaka", "Walker", "Young"]
+
+def stats(times):
+    """Summary of a list of durations (in seconds)."""
+    times = sorted(times)
+    n = len(times)
+    return dict(n=n, min=times[0], max=times[-1],
+            mean=sum(times) / n, median=times[n // 2],
+            p95=times[min(n - 1, int(n * 0.95))])
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+class Quiet(object):
+    """Discard output (e.g. "signed in" messages) while timing."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+class SlowBackend(object):
+    """Wraps a backend, adding a delay to each time record upload to stand
+    in for a slow network."""
+    def __init__(self, backend, delay):
+        self.backend = backend
+        self.delay = delay
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def putTimeRecords(self, records):
+        time.sleep(self.delay)
+        return self.backend.putTimeRecords(records)
+
+def writeRoster(filename, count, rand):
+    with open(filename, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ID", "Name", "Student?", "Photo Path"])
+        for id in range(1, count + 1):
+            writer.writerow([id, "%s %s %d" % (rand.choice(FIRST_NAMES),
+                    rand.choice(LAST_NAMES), id),
+                    "no" if rand.random() < 0.2 else "yes", ""])
+
+def addTimeLog(store, count, rand):
+    """Add count completed time records for random people, then
+    checkpoint."""
+    people = list(store.people.values())
+    start = datetime.now() - timedelta(days=365)
+    for i in range(count):
+        record = TimeRecord(rand.choice(people),
+                start + timedelta(minutes=rand.randrange(365 * 24 * 60)))
+        record.outTime = record.inTime + timedelta(
+                minutes=rand.randrange(30, 300))
+        record.hours = round((record.outTime - record.inTime)
+                .total_seconds() / 3600.0, 2)
+        record.recorded = record.outTime
+        store.timeLog.append(record)
+    store.save()
+
+class Benchmark(object):
+    def __init__(self, scale, storage, repeat, scans, seed=294):
+        self.scale = scale
+        self.storage = storage
+        self.repeat = repeat
+        self.scans = min(scans, scale)
+        self.rand = random.Random(seed)
+        self.config = ConfigParser()
+        self.config.add_section('csv')
+        self.config.set('csv', 'PEOPLE_FILE', "people.csv")
+        self.config.set('csv', 'RECORDS_FILE', "records.csv")
+        self.backend = backend_csv.Backend(self.config)
+        self.results = {}
+
+    def newStore(self, backend=None):
+        backend = backend or self.backend
+        if self.storage == 'sqlite':
+            import datastore_sqlite
+            return datastore_sqlite.SqliteDataStore(backend)
+        return datastore.DataStore(backend)
+
+    def badges(self, store):
+        return self.rand.sample(sorted(person.badge
+            for person in store.people.values()), self.scans)
+
+    def run(self):
+        writeRoster("people.csv", self.scale, self.rand)
+        with open("records.csv", "w") as f:
+            f.write("ID,Name,Student?,Event,Clocked In,Clocked Out,Hours,"
+                    "Recorded\n")
+
+        # Initial sync imports the roster
+        store = self.newStore()
+        store.load()
+        self.results['sync_people'] = stats([timed(store.sync)])
+        addTimeLog(store, self.scale, self.rand)
+
+        self.results['save'] = stats([timed(store.save)
+            for i in range(self.repeat)])
+        loads = []
+        for i in range(self.repeat):
+            store = self.newStore()
+            loads.append(timed(store.load))
+        self.results['load'] = stats(loads)
+
+        self.benchSignInOut(store)
+        self.benchSearch(store)
+
+        # signOutAll with scans people signed in
+        store.signInOutMany(self.badges(store))
+        self.results['signOutAll'] = stats([timed(store.signOutAll)])
+
+        # Push the whole time log (the person list is unchanged)
+        self.results['sync_push'] = stats([timed(store.sync)])
+
+        self.benchScanDuringSync()
+        return self.results
+
+    def benchSignInOut(self, store):
+        badges = self.badges(store)
+        # each badge signs in, then out again
+        self.results['signInOut'] = stats([timed(store.signInOut, badge)
+            for badge in badges + badges])
+        batch = 25
+        times = []
+        for start in range(0, len(badges), batch):
+            times.append(timed(store.signInOutMany,
+                badges[start:start+batch]))
+        self.results['signInOutMany_25'] = stats(times)
+
+    def benchSearch(self, store):
+        self.results['buildNameIndex'] = stats([timed(store.buildNameIndex)])
+        names = [person.name for person in store.people.values()]
+        queries = []
+        for i in range(100):
+            name = self.rand.choice(names)
+            length = self.rand.choice((1, 2, 3, 5, 8))
+            start = self.rand.randrange(max(1, len(name) - length))
+            queries.append(name[start:start+length])
+        # what FindDlg does: one search per keystroke
+        self.results['findPeople'] = stats([timed(store.findPeople, query)
+            for query in queries])
+
+    def benchScanDuringSync(self):
+        """Latency of scans made while a sync is uploading the time log
+        over a slow link, compared with scans with no sync running."""
+        store = self.newStore(SlowBackend(self.backend, 0.05))
+        store.load()
+        addTimeLog(store, self.scale, self.rand)
+        badges = self.badges(store)
+        self.results['signInOut_idle'] = stats([timed(store.signInOut, badge)
+            for badge in badges[:100]])
+
+        thread = threading.Thread(target=store.sync)
+        thread.start()
+        times = []
+        for badge in badges[100:] + badges:
+            if not thread.is_alive():
+                break
+            times.append(timed(store.signInOut, badge))
+            time.sleep(0.005)
+        thread.join()
+        if times:
+            self.results['signInOut_during_sync'] = stats(times)
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=HERE, stderr=open(os.devnull, "w")).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scales", default="100,10000,100000",
+            help="comma separated roster sizes (default %(default)s)")
+    parser.add_argument("--storage", choices=("pickle", "sqlite"),
+            default="pickle")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="times to repeat load and save")
+    parser.add_argument("--scans", type=int, default=500,
+            help="badge scans per scan benchmark")
+    parser.add_argument("-o", "--output",
+            help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    report = dict(commit=gitCommit(), python=platform.python_version(),
+            platform=platform.platform(), storage=args.storage,
+            date=datetime.now().isoformat(), scales={})
+    cwd = os.getcwd()
+    for scale in [int(s) for s in args.scales.split(",")]:
+        scratch = tempfile.mkdtemp(prefix="signinbench")
+        os.chdir(scratch)
+        try:
+            with Quiet():
+                report['scales'][str(scale)] = Benchmark(scale, args.storage,
+                        args.repeat, args.scans).run()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(scratch, ignore_errors=True)
+        print("scale %d done" % scale, file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -1,172 +1,768 @@
 from __future__ import print_function
+import numbers
 import os
 import pickle
-import backend_roster as backend
-from PyQt4.QtCore import QObject, QMutex, QMutexLocker, pyqtSignal
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from fileutil import atomicWrite, getFileLock, statSignature
+from metrics import metrics
 from models import *
+from nameindex import NameIndex
+from photos import PhotoManifest
+from signals import Signal
+from timelog import TimeLog, writeEntries, readEntry
+from workers import runConcurrently
 
-class DataStore(QObject):
-    statusUpdate = pyqtSignal(str)
-    statsChanged = pyqtSignal()
+SNAPSHOT_FILE = "DataStore.pickle"
+JOURNAL_FILE = "DataStore.journal"
+# Held while changing the store, so that the kiosk and a sync daemon (see
+# syncd.py) can share it
+LOCK_FILE = "DataStore.lock"
+# Held for the duration of a sync, so only one process syncs at a time
+SYNC_LOCK_FILE = "DataStore.sync.lock"
 
-    def __init__(self, backend):
-        super(DataStore, self).__init__()
+class StoreLock(object):
+    """Holds the store's (recursive) thread lock and, while held by the
+    outermost caller, the lock file shared with other processes.  On
+    taking the lock file the store is refreshed with any changes other
+    processes made.  Time spent waiting is recorded in the metrics."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        store = self.store
+        start = time.time()
+        store.mutex.acquire()
+        store.lockDepth += 1
+        if store.lockDepth == 1:
+            try:
+                store.fileLock.acquire()
+            except:
+                store.lockDepth -= 1
+                store.mutex.release()
+                raise
+        wait = time.time() - start
+        if wait > 0.0001: # only record actual contention
+            metrics.observe("datastore_mutex_wait_seconds", wait)
+        if store.lockDepth == 1:
+            try:
+                store.refresh()
+                store.refreshPhotos()
+            except:
+                self.__exit__()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        store = self.store
+        store.lockDepth -= 1
+        if store.lockDepth == 0:
+            store.fileLock.release()
+        store.mutex.release()
+
+# Counts shown in the status bar, taken together under the lock
+Stats = namedtuple('Stats', 'people clockedIn timeEntries')
+
+class DataStore(object):
+    """People, who is clocked in and time records not yet pushed to the
+    backend.  Doesn't need Qt; signals are plain callbacks, emitted on
+    whichever thread made the change."""
+    statusUpdate = Signal(str)
+    # Stats after a change; emitted once per operation
+    statsChanged = Signal(object)
+    # ids of people whose details changed during sync
+    peopleUpdated = Signal(list)
+    # ids of people signed in, out or cleared by an operation (one emit for
+    # the whole operation, once it is durable)
+    recordsChanged = Signal(list)
+    # local filename of photo just downloaded; emitted on the photo worker
+    # thread
+    photoUpdated = Signal(str)
+    # the store was re-read after being changed by another process
+    reloaded = Signal()
+
+    def __init__(self, backend, checkpointInterval=1000, photoWorkers=4,
+            photoRetries=2, uploadBatchSize=200, uploadConcurrency=2):
         self.backend = backend
-        self.mutex = QMutex(QMutex.Recursive)
+        self.mutex = threading.RLock()
+        self.lockDepth = 0 # nesting of locked() by the thread holding mutex
+        self.fileLock = getFileLock(LOCK_FILE)
+        self.syncLock = getFileLock(SYNC_LOCK_FILE)
+        # What the store files looked like when last read or written by
+        # this process (None until loaded)
+        self.snapshotSignature = None
+        self.journalSize = None
         self.people = {}
-        self.timeLog = []
+        # Completed records not yet pushed; see timelog.py
+        self.timeLog = TimeLog(self)
         self.clockedIn = {}
         self.badgeToId = {}
+        # Opaque value from the backend identifying the last person list
+        # fetched, so unchanged lists needn't be downloaded again
+        self.personListVersion = None
+        # Journal state; a checkpoint (save) is forced after
+        # checkpointInterval journal entries.
+        self.checkpointInterval = checkpointInterval
+        self.generation = 0
+        self.journalFile = None
+        self.journalEntries = 0
+        # Photo downloads are done by photoWorkers threads, each photo
+        # being attempted up to photoRetries additional times
+        self.photoWorkers = photoWorkers
+        self.photoRetries = photoRetries
+        # Time records are pushed in batches of uploadBatchSize, with up to
+        # uploadConcurrency batches in flight
+        self.uploadBatchSize = uploadBatchSize
+        self.uploadConcurrency = uploadConcurrency
+        # Name search index; built during sync (or on first search) and
+        # then kept up to date by updatePeople
+        self.nameIndex = None
+        self.peopleSerial = 0 # incremented whenever people change
+        # People whose photos need checking at the next sync if the person
+        # list is unchanged (None means everyone)
+        self.photosToRetry = None
+        # Downloaded photos; see photos.py
+        self.photos = PhotoManifest()
+
+    def locked(self):
+        """Context manager to hold while reading or changing the store."""
+        return StoreLock(self)
 
+    @metrics.timed("datastore_load_seconds")
     def load(self):
-        # Load pickles or create fresh if no pickle file
-        with QMutexLocker(self.mutex):
-            try:
-                with open("DataStore.pickle", "rb") as f:
-                    unpickler = pickle.Unpickler(f)
-                    self.people = unpickler.load()
-                    self.clockedIn = unpickler.load()
-                    self.timeLog = unpickler.load()
+        with self.locked():
+            if self.readStore():
                 self.statusUpdate.emit(
                         "Loaded %d people (%d clocked in) and %d time records." %
                         (len(self.people), len(self.clockedIn),
                          len(self.timeLog)))
-                for record in self.clockedIn.values():
-                    record.completed.connect(self.handle_signout)
-                for person in self.people.values():
-                    self.badgeToId[person.badge] = person.id
+            self.statsChanged.emit(self.stats())
+
+    def refresh(self):
+        """Called with the lock file newly taken: catch up with changes
+        another process made since this one last read or wrote the store.
+        Journal entries appended by it are replayed; if it wrote a new
+        snapshot the whole store is read again."""
+        if self.journalSize is None:
+            return # not loaded yet
+        snapshot = statSignature(SNAPSHOT_FILE)
+        journal = statSignature(JOURNAL_FILE)
+        journalSize = journal[1] if journal else 0
+        if snapshot == self.snapshotSignature and \
+                journalSize == self.journalSize:
+            return
+        if snapshot != self.snapshotSignature or \
+                journalSize < self.journalSize:
+            self.readStore()
+            self.peopleSerial += 1
+        else:
+            with open(JOURNAL_FILE, "rb") as f:
+                f.seek(self.journalSize)
+                self.journalSize = self.replayJournalEntries(f,
+                        self.journalSize)
+        self.reloaded.emit()
+        self.statsChanged.emit(self.stats())
+
+    def refreshPhotos(self):
+        """Called with the lock file newly taken: pick up photos another
+        process downloaded."""
+        if self.photos.refresh():
+            self.reloaded.emit()
+
+    def photoFile(self, person):
+        """Downloaded photo for person, or None.  Doesn't touch the disk."""
+        return self.photos.photoFile(person)
+
+    def readStore(self):
+        """Load snapshot (or create fresh if no snapshot file), then replay
+        any journal entries written since that snapshot.  Returns True if
+        anything was loaded."""
+        with self.locked():
+            self.people = {}
+            self.clockedIn = {}
+            self.badgeToId = {}
+            self.generation = 0
+            self.personListVersion = None
+            self.nameIndex = None
+            loaded = False
+            try:
+                with open(SNAPSHOT_FILE, "rb") as f:
+                    unpickler = pickle.Unpickler(f)
+                    self.people = unpickler.load()
+                    self.clockedIn = unpickler.load()
+                    timeLog = unpickler.load()
+                    # older snapshots end early; keep the defaults
+                    try:
+                        self.generation = unpickler.load()
+                        self.personListVersion = unpickler.load()
+                    except EOFError:
+                        pass
+                loaded = True
             except (IOError, EOFError):
                 self.people = {}
-                self.timeLog = []
                 self.clockedIn = {}
-                self.badgeToId = {}
-            self.statsChanged.emit()
+                timeLog = None
+            if isinstance(timeLog, list):
+                # snapshot from before the time log was segmented
+                self.timeLog.setState(None)
+                for record in timeLog:
+                    self.timeLog.append(record)
+            else:
+                self.timeLog.setState(timeLog)
+            self.snapshotSignature = statSignature(SNAPSHOT_FILE)
+            for person in self.people.values():
+                self.badgeToId[person.badge] = person.id
+            replayed = self.replayJournal()
+            if replayed is None:
+                self.startJournal()
+            return bool(loaded or replayed)
+
+    def replayJournal(self):
+        """Apply journal entries written since the last checkpoint.
+        Returns number of entries applied, or None if there is no journal
+        for the current snapshot."""
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
+        self.journalEntries = 0
+        try:
+            f = open(JOURNAL_FILE, "rb")
+        except IOError:
+            return None
+        with f:
+            entry, good = self.readJournalEntry(f)
+            if entry != ('journal', self.generation):
+                # journal predates the snapshot (or is unreadable); the
+                # snapshot already contains everything in it
+                return None
+            good = self.replayJournalEntries(f, good)
+
+        # Drop any partially written entry at the end so new entries
+        # aren't appended after garbage
+        if os.path.getsize(JOURNAL_FILE) != good:
+            with open(JOURNAL_FILE, "r+b") as f:
+                f.truncate(good)
+        self.journalSize = good
+        return self.journalEntries
+
+    def replayJournalEntries(self, f, offset):
+        """Apply the entries in f from offset on.  Returns the offset after
+        the last complete entry."""
+        while True:
+            entry, end = self.readJournalEntry(f)
+            if entry is None:
+                return offset
+            self.applyJournalEntry(entry)
+            self.journalEntries += 1
+            offset = end
+
+    def readJournalEntry(self, f):
+        """Read one entry from the journal.  Returns (entry, offset after
+        entry), or (None, None) at end of file or on a torn entry."""
+        return readEntry(f)
+
+    def applyJournalEntry(self, entry):
+        kind = entry[0]
+        if kind == 'in':
+            id, inTime = entry[1:]
+            if id in self.clockedIn:
+                return
+            person = self.people.get(id)
+            if person is None:
+                # not in the snapshot (e.g. added by a person list update
+                # that an older version didn't checkpoint); the hours are
+                # still due, and only the id is sent
+                print("Journal: sign in of unknown person %d at %s" %
+                        (id, inTime))
+                person = Person(id, "", True, "", 0, 0)
+            self.clockedIn[id] = TimeRecord(person, inTime)
+        elif kind in ('out', 'clear'):
+            id, outTime, hours, recorded = entry[1:]
+            record = self.clockedIn.pop(id, None)
+            if record is None:
+                print("Journal: sign out of person %d, who wasn't signed in" %
+                        id)
+                return
+            record.outTime = outTime
+            record.hours = hours
+            record.recorded = recorded
+            self.timeLog.append(record)
+        elif kind == 'ack':
+            self.removeTimeRecords(entry[1])
+
+    def journal(self, *entries):
+        """Durably append entries to the journal.  Periodically checkpoints
+        the journal into a full snapshot.  Entries must be journaled after
+        the change they describe is applied to the in-memory state."""
+        if not entries:
+            return
+        with self.locked():
+            self.writeJournal(entries)
+            self.journalEntries += len(entries)
+            if self.journalEntries >= self.checkpointInterval:
+                self.save()
+
+    def writeJournal(self, entries):
+        if self.journalFile is None:
+            self.journalFile = open(JOURNAL_FILE, "ab")
+        size = writeEntries(self.journalFile, entries)
+        self.journalFile.flush()
+        with metrics.timer("journal_fsync_seconds"):
+            os.fsync(self.journalFile.fileno())
+        self.journalSize = self.journalFile.tell()
+        metrics.count("journal_bytes_total", size)
 
+    @metrics.timed("datastore_save_seconds")
     def save(self):
-        with QMutexLocker(self.mutex):
-            with open("DataStore.pickle", "wb") as f:
+        """Checkpoint: write a full snapshot and start a fresh journal.
+        Time records completed since the last checkpoint are appended to
+        the time log segments; the snapshot only describes the segments."""
+        with self.locked():
+            generation = self.generation + 1
+            self.timeLog.flush()
+            with atomicWrite(SNAPSHOT_FILE) as f:
                 pickler = pickle.Pickler(f)
                 pickler.dump(self.people)
                 pickler.dump(self.clockedIn)
-                pickler.dump(self.timeLog)
+                pickler.dump(self.timeLog.state())
+                pickler.dump(generation)
+                pickler.dump(self.personListVersion)
+            self.snapshotSignature = statSignature(SNAPSHOT_FILE)
+            self.generation = generation
+            # entries in the old journal are now in the snapshot (and would
+            # be ignored anyway due to the generation mismatch)
+            self.startJournal()
+
+    def startJournal(self):
+        """Truncate the journal and mark it as following the current
+        snapshot generation."""
+        with self.locked():
+            if self.journalFile is not None:
+                self.journalFile.close()
+            # truncate, then append (as anything written to the journal by
+            # another process must not be overwritten)
+            open(JOURNAL_FILE, "wb").close()
+            self.journalFile = open(JOURNAL_FILE, "ab")
+            self.writeJournal([('journal', self.generation)])
+            self.journalEntries = 0
+
+    def findPeople(self, text):
+        """Returns list of (name, badge) of people whose name contains text
+        (case insensitive), sorted by name."""
+        with self.locked():
+            if self.nameIndex is None:
+                self.nameIndex = NameIndex(self.people.values())
+            return self.nameIndex.find(text)
+
+    def buildNameIndex(self):
+        """Build the name index without holding the mutex, so that it can
+        be done on the sync thread without blocking sign ins."""
+        with self.locked():
+            if self.nameIndex is not None:
+                return
+            people = list(self.people.values())
+            serial = self.peopleSerial
+        index = NameIndex(people)
+        index.sort()
+        with self.locked():
+            if self.nameIndex is None and serial == self.peopleSerial:
+                self.nameIndex = index
+
+    def updateNameIndex(self, people=(), removed=()):
+        """Bring the name index (if built) up to date with changes to
+        people."""
+        self.peopleSerial += 1
+        if self.nameIndex is None:
+            return
+        for person in people:
+            self.nameIndex.add(person)
+        for id in removed:
+            self.nameIndex.remove(id)
+
+    def stats(self):
+        """Returns Stats snapshot."""
+        with self.locked():
+            return Stats(len(self.people), len(self.clockedIn),
+                    len(self.timeLog))
 
     def getNumPeople(self):
-        with QMutexLocker(self.mutex):
+        with self.locked():
             return len(self.people)
 
     def getNumTimeEntries(self):
-        with QMutexLocker(self.mutex):
+        with self.locked():
             return len(self.timeLog)
 
     def getNumClockedIn(self):
-        with QMutexLocker(self.mutex):
+        with self.locked():
             return len(self.clockedIn)
 
-    def handle_signout(self):
-        record = self.sender()
-        id = record.person.id
-        print("handling %d signing out" % id)
-        with QMutexLocker(self.mutex):
-            record = self.clockedIn.pop(id, None)
-            if record is not None:
-                self.timeLog.append(record)
-            self.statsChanged.emit()
-
     def signInOut(self, badge):
         """Sign person in or out (based on their current state).
         Returns None if person was previously signed in,
         otherwise returns created TimeRecord."""
-        with QMutexLocker(self.mutex):
-            id = self.badgeToId[badge]
-            person = self.people[id]
-            record = self.clockedIn.pop(id, None)
-            if record is not None:
-                # signing out
-                record.signOut()
-                self.timeLog.append(record)
-                self.save()
-                self.statsChanged.emit()
-                return None
-            else:
-                # signing in
-                record = TimeRecord(person)
-                record.completed.connect(self.handle_signout)
-                self.clockedIn[id] = record
-                self.save()
-                self.statsChanged.emit()
-                return record
+        badge, person, record, signedIn = self.signInOutMany([badge])[0]
+        if person is None:
+            raise KeyError(badge)
+        return record if signedIn else None
+
+    @metrics.timed("datastore_sign_in_out_seconds")
+    def signInOutMany(self, badges):
+        """Sign each badge in or out in turn, persisting all of them with a
+        single journal write.  Returns list of (badge, person, record,
+        signedIn) in order; person and record are None for an unknown
+        badge.  Nothing is signalled until the whole batch is durable."""
+        metrics.count("scans_total", len(badges))
+        return [result[:4] for result in
+                self.toggleMany([(None, badge) for badge in badges])]
+
+    @metrics.timed("datastore_apply_events_seconds")
+    def applyEvents(self, events):
+        """Replay scans made elsewhere (e.g. a handheld scanner's log while
+        the kiosk was down).  events is a sequence of (time, badge) in the
+        order scanned; badge may be a number or the text scanned (see
+        parseBadge).  Each person is signed in or out as of the event's
+        time, and everything is persisted with a single journal write.
+        Returns list of (badge, person, record, signedIn, error) in order;
+        error is None if the event was applied, otherwise it says why the
+        event was skipped."""
+        return self.toggleMany(events)
+
+    def toggleMany(self, events):
+        now = datetime.now()
+        with self.locked():
+            results = []
+            entries = []
+            changed = []
+            for when, badge in events:
+                if not isinstance(badge, numbers.Integral):
+                    try:
+                        badge = parseBadge(badge)
+                    except ValueError as e:
+                        results.append((badge, None, None, False, str(e)))
+                        continue
+                id = self.badgeToId.get(badge)
+                person = None if id is None else self.people.get(id)
+                if person is None:
+                    results.append((badge, None, None, False,
+                        "User %d does not exist" % badge))
+                    continue
+                if when is not None and when > now:
+                    results.append((badge, person, None, False,
+                        "%s is in the future" % when))
+                    continue
+                record = self.clockedIn.get(id)
+                if record is not None:
+                    if when is not None and when < record.inTime:
+                        results.append((badge, person, None, False,
+                            "%s is before %s signed in at %s" %
+                            (when, person, record.inTime)))
+                        continue
+                    # signing out
+                    del self.clockedIn[id]
+                    record.signOut(when)
+                    self.timeLog.append(record)
+                    entries.append(('out', id, record.outTime, record.hours,
+                            record.recorded))
+                    changed.append(id)
+                    results.append((badge, person, record, False, None))
+                else:
+                    # signing in
+                    record = TimeRecord(person, when)
+                    print("%s signed in" % person)
+                    self.clockedIn[id] = record
+                    entries.append(('in', id, record.inTime))
+                    changed.append(id)
+                    results.append((badge, person, record, True, None))
+            self.journal(*entries)
+            if entries:
+                # each person once, in the order first changed
+                seen = set()
+                self.recordsChanged.emit([id for id in changed
+                    if not (id in seen or seen.add(id))])
+                self.statsChanged.emit(self.stats())
+            return results
 
     def clearAll(self):
         """Clear all clocked in records.  They will be saved in the time log
         but with no hours credit."""
-        with QMutexLocker(self.mutex):
+        with self.locked():
+            entries = []
             while self.clockedIn:
-                record = self.clockedIn.popitem()[1]
+                id, record = self.clockedIn.popitem()
                 record.clear()
                 self.timeLog.append(record)
-            self.save()
-            self.statsChanged.emit()
+                entries.append(('clear', id, record.outTime, record.hours,
+                        record.recorded))
+            self.journal(*entries)
+            if entries:
+                self.recordsChanged.emit([entry[1] for entry in entries])
+            self.statsChanged.emit(self.stats())
 
     def signOutAll(self):
         """Sign out all clocked in records."""
-        with QMutexLocker(self.mutex):
+        with self.locked():
+            entries = []
             while self.clockedIn:
-                record = self.clockedIn.popitem()[1]
+                id, record = self.clockedIn.popitem()
                 record.signOut()
                 self.timeLog.append(record)
+                entries.append(('out', id, record.outTime, record.hours,
+                        record.recorded))
+            self.journal(*entries)
+            if entries:
+                self.recordsChanged.emit([entry[1] for entry in entries])
+            self.statsChanged.emit(self.stats())
+
+    def updatePeople(self, newpeople, version=None):
+        """Apply the person list fetched from the backend: add new people,
+        update changed ones and remove those no longer listed.  Returns
+        list of ids of existing people who changed or were removed."""
+        with self.locked():
+            updated = []
+            changed = []
+            seen = set()
+            for person in newpeople:
+                seen.add(person.id)
+                existing = self.people.get(person.id)
+                if existing is None:
+                    record = self.clockedIn.get(person.id)
+                    if record is not None:
+                        # signed in while unknown (see applyJournalEntry)
+                        record.person.updateFrom(person)
+                        person = record.person
+                    self.people[person.id] = person
+                    self.badgeToId[person.badge] = person.id
+                    updated.append(person)
+                    continue
+                oldBadge = existing.badge
+                if existing.updateFrom(person):
+                    updated.append(existing)
+                    changed.append(person.id)
+                    if oldBadge != existing.badge:
+                        if self.badgeToId.get(oldBadge) == person.id:
+                            del self.badgeToId[oldBadge]
+                        self.badgeToId[existing.badge] = person.id
+            removed = [id for id in self.people if id not in seen]
+            for id in removed:
+                # anyone clocked in keeps their record (and Person)
+                person = self.people.pop(id)
+                if self.badgeToId.get(person.badge) == id:
+                    del self.badgeToId[person.badge]
+                changed.append(id)
+            self.updateNameIndex(updated, removed)
+            self.personListVersion = version
+            # people aren't journaled; checkpoint so that journal entries
+            # referring to new people can be replayed
             self.save()
-            self.statsChanged.emit()
+            return changed
+
+    def pendingTimeRecords(self):
+        """Returns sequence of time records that need to be pushed to the
+        backend."""
+        with self.locked():
+            return self.timeLog.pending()
+
+    def acknowledgeTimeRecords(self, pending, ok):
+        """Remove records accepted by the backend.  ok is the set of indices
+        into pending (as returned by pendingTimeRecords).  Records are
+        identified by their number in the time log, so anything added
+        since pending was taken is kept."""
+        with self.locked():
+            acked = [pending.seqs[i] for i in ok]
+            self.removeTimeRecords(acked)
+            self.journal(('ack', acked))
+
+    def removeTimeRecords(self, acked):
+        if acked and isinstance(acked[0], tuple):
+            # (person id, sign in time) keys from an older journal
+            self.timeLog.removeKeys(acked)
+        else:
+            self.timeLog.acknowledge(acked)
+
+    def fetchPhoto(self, person):
+        """Download person's photo, retrying on failure.  Called on photo
+        worker threads."""
+        filename = self.photos.downloadName(person)
+        for attempt in range(self.photoRetries + 1):
+            try:
+                # taken first, so a replacement during the copy is noticed
+                # next time
+                version = self.photoVersion(person.photoRemote)
+                self.backend.getBadgePhoto(person.photoRemote, filename)
+                self.photoUpdated.emit(self.photos.add(person.photoRemote,
+                    person.photoSize, filename, version))
+                return
+            except IOError:
+                if attempt == self.photoRetries:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def photoVersion(self, photoRemote):
+        """Backend's version of a photo, for backends whose photos can be
+        replaced without the person list changing (None otherwise)."""
+        if hasattr(self.backend, 'photoVersion'):
+            return self.backend.photoVersion(photoRemote)
+        return None
+
+    def syncPhotos(self, people):
+        """Download photos that haven't been (or that have changed on the
+        backend since).  Returns list of people whose photos failed to
+        download."""
+        todo = []
+        versions = {} # each source checked once, however many share it
+        for person in people:
+            if not person.photoRemote or not person.photoSize:
+                continue
+            if person.photoRemote not in versions:
+                versions[person.photoRemote] = \
+                        self.photoVersion(person.photoRemote)
+            version = versions[person.photoRemote]
+            if self.photos.isCurrent(person, version):
+                continue
+            if self.photos.photoFile(person) is None and \
+                    self.photos.adopt(person, version) is not None:
+                continue
+            todo.append(person)
+        if not todo:
+            self.photos.save()
+            return []
+
+        self.statusUpdate.emit("Downloading %d photos" % len(todo))
+        done = 0
+        failed = []
+        try:
+            for person, result, e in runConcurrently(self.fetchPhoto, todo,
+                    self.photoWorkers):
+                done += 1
+                if e is not None:
+                    metrics.count("photo_download_failures_total")
+                    failed.append(person)
+                    self.statusUpdate.emit("Failed when downloading %s: %s" %
+                            (person.photoRemote, e))
+                else:
+                    self.statusUpdate.emit("Downloaded %d of %d photos" %
+                            (done, len(todo)))
+        finally:
+            self.photos.save()
+        return failed
+
+    def pushTimeRecords(self, pending):
+        """Push pending time records to the backend in batches.  Records
+        accepted by each batch are removed (and that persisted) as soon as
+        the batch completes, so an interrupted push resumes from the first
+        unacknowledged record.  Returns (number pushed, first error)."""
+        size = self.uploadBatchSize
+        errors = []
+
+        def batches():
+            # Runs on this thread, building the next batch while earlier
+            # ones are being sent; stops at the first failure
+            for start in range(0, len(pending), size):
+                if errors:
+                    return
+                # records that can't be read are left out, so the
+                # acknowledged indices are into what was actually sent
+                yield pending[start:start+size].loaded()
+
+        def put(batch):
+            return self.backend.putTimeRecords(batch[1])
+
+        pushed = 0
+        for (sent, records), ok, e in runConcurrently(put, batches(),
+                self.uploadConcurrency):
+            if e is not None:
+                if not isinstance(e, IOError):
+                    raise e
+                metrics.count("upload_failures_total")
+                errors.append(e)
+                continue
+            self.acknowledgeTimeRecords(sent, ok)
+            pushed += len(ok)
+            self.statusUpdate.emit("Pushed %d of %d time records" %
+                    (pushed, len(pending)))
+        return pushed, errors[0] if errors else None
 
     def sync(self):
-        # Update people from backend
+        """Synchronize with the backend, unless another process (e.g. the
+        sync daemon) is already doing so."""
+        if not self.syncLock.acquire(blocking=False):
+            self.statusUpdate.emit("Synchronization already in progress")
+            return
         try:
-            newpeople = self.backend.getPersonList()
-            with QMutexLocker(self.mutex):
-                self.badgeToId = {}
-                for person in newpeople:
-                    if person.id in self.people:
-                        self.people[person.id].updateFrom(person)
-                    else:
-                        self.people[person.id] = person
-                    self.badgeToId[person.badge] = person.id
+            self.doSync()
+        finally:
+            self.syncLock.release()
+
+    @metrics.timed("datastore_sync_seconds")
+    def doSync(self):
+        # Update people from backend (if changed since last time)
+        try:
+            newpeople, version = self.backend.getPersonListIfChanged(
+                    self.personListVersion)
+            changed = []
+            if newpeople is not None:
+                changed = self.updatePeople(newpeople, version)
         except IOError as e:
             # Unlikely we'll be able to do anything else
             self.statusUpdate.emit("Could not contact server to synchronize: %s" % e)
             return
+        if changed:
+            self.peopleUpdated.emit(changed)
 
         # Download photos as necessary
-        for person in newpeople:
-            size = 0
-            if person.photo:
-                try:
-                    size = os.stat(person.photo).st_size
-                except OSError:
-                    pass
-            if person.photoRemote and size != person.photoSize:
-                self.statusUpdate.emit("Downloading %s" % person.photoRemote)
-                try:
-                    self.backend.getBadgePhoto(person.photoRemote, person.photo)
-                except IOError as e:
-                    self.statusUpdate.emit("Failed when downloading %s: %s" %
-                            (person.photo, e))
-
-        # Push saved time log to server
-        with QMutexLocker(self.mutex):
-            if self.timeLog:
-                try:
-                    self.statusUpdate.emit("Pushing %d time records" %
-                            len(self.timeLog))
-                    ok = self.backend.putTimeRecords(self.timeLog)
-                except IOError as e:
-                    self.statsChanged.emit()
-                    self.statusUpdate.emit("Failed to push time records: %s" % e)
-                    return
-                self.timeLog = [v for i, v in enumerate(self.timeLog) if i not in ok]
-                self.statusUpdate.emit("Pushed %d time records" % len(ok))
+        if newpeople is None:
+            # the csv backend's photos can be replaced on disk without the
+            # person list changing, so they are all checked
+            if self.photosToRetry is None or \
+                    hasattr(self.backend, 'photoVersion'):
+                with self.locked():
+                    newpeople = list(self.people.values())
             else:
-                self.statusUpdate.emit("Synchronization complete")
+                newpeople = self.photosToRetry
+        else:
+            # photos nobody on the new roster uses can go
+            self.photos.prune(newpeople)
+        self.photosToRetry = self.syncPhotos(newpeople)
+        self.buildNameIndex()
+
+        # Push saved time log to server.  The mutex is only held while
+        # taking the snapshot of pending records and while applying each
+        # batch's acknowledgements, so sign ins/outs aren't blocked by the
+        # network; records added meanwhile are simply pushed next time.
+        pending = self.pendingTimeRecords()
+        if pending:
+            self.statusUpdate.emit("Pushing %d time records" %
+                    len(pending))
+            pushed, e = self.pushTimeRecords(pending)
+            if e is not None:
+                self.statsChanged.emit(self.stats())
+                self.statusUpdate.emit("Failed to push time records "
+                        "(%d pushed): %s" % (pushed, e))
+                return
+            self.statusUpdate.emit("Pushed %d time records" % pushed)
+        else:
+            self.statusUpdate.emit("Synchronization complete")
+
+        self.statsChanged.emit(self.stats())
 
-            self.statsChanged.emit()
+def fromConfig(config, backend):
+    """Create the data store configured in the global section of
+    settings.ini."""
+    options = dict(
+            photoWorkers=config.getint('global', 'PHOTO_WORKERS'),
+            photoRetries=config.getint('global', 'PHOTO_RETRIES'),
+            uploadBatchSize=config.getint('global', 'UPLOAD_BATCH_SIZE'),
+            uploadConcurrency=config.getint('global', 'UPLOAD_CONCURRENCY'))
+    if config.get('global', 'STORAGE') == 'sqlite':
+        import datastore_sqlite
+        return datastore_sqlite.SqliteDataStore(backend, **options)
+    return DataStore(backend,
+            checkpointInterval=config.getint('global', 'JOURNAL_CHECKPOINT'),
+            **options)
 
 if __name__ == "__main__":
     try:
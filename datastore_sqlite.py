@@ -0,0 +1,396 @@
+from __future__ import print_function
+import os
+import pickle
+import sqlite3
+from datastore import DataStore, SNAPSHOT_FILE
+from metrics import metrics
+from models import *
+
+DATABASE_FILE = "DataStore.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS people (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    student INTEGER NOT NULL,
+    photo TEXT NOT NULL,
+    photo_size INTEGER NOT NULL,
+    badge INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS people_badge ON people (badge);
+CREATE TABLE IF NOT EXISTS clocked_in (
+    person INTEGER PRIMARY KEY,
+    in_time TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS time_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    person INTEGER NOT NULL,
+    in_time TIMESTAMP NOT NULL,
+    out_time TIMESTAMP,
+    hours REAL NOT NULL,
+    recorded TIMESTAMP,
+    synced INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS time_records_synced ON time_records (synced, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value BLOB
+);
+"""
+
+PERSON_COLUMNS = "id, name, student, photo, photo_size, badge"
+
+# Number of rows fetched at a time when streaming time records
+FETCH_SIZE = 500
+
+def personFromRow(row):
+    id, name, student, photo, photoSize, badge = row
+    return Person(id, name, bool(student), photo, photoSize, badge)
+
+class PeopleTable(object):
+    """Read-mostly dict-like view of the people table.  Person objects are
+    created on demand; people who are clocked in are always returned as the
+    same object held by their TimeRecord."""
+
+    def __init__(self, store):
+        self.store = store
+        self.db = store.db
+
+    def lookup(self, id):
+        record = self.store.clockedIn.get(id)
+        if record is not None:
+            return record.person
+        row = self.db.execute("SELECT %s FROM people WHERE id = ?" %
+                PERSON_COLUMNS, (id,)).fetchone()
+        if row is None:
+            return None
+        return personFromRow(row)
+
+    def get(self, id, default=None):
+        person = self.lookup(id)
+        return default if person is None else person
+
+    def __getitem__(self, id):
+        person = self.lookup(id)
+        if person is None:
+            raise KeyError(id)
+        return person
+
+    def __contains__(self, id):
+        return self.db.execute("SELECT 1 FROM people WHERE id = ?",
+                (id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM people").fetchone()[0]
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for row in self.db.execute("SELECT id FROM people"):
+            yield row[0]
+
+    def values(self):
+        cursor = self.db.execute("SELECT %s FROM people" % PERSON_COLUMNS)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                record = self.store.clockedIn.get(row[0])
+                if record is not None:
+                    yield record.person
+                else:
+                    yield personFromRow(row)
+
+    def put(self, person):
+        self.db.execute("INSERT OR REPLACE INTO people (%s) "
+                "VALUES (?, ?, ?, ?, ?, ?)" % PERSON_COLUMNS,
+                (person.id, person.name, int(person.student),
+                 person.photoRemote, person.photoSize, person.badge))
+
+class BadgeTable(object):
+    """Dict-like view mapping badge to person id."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def lookup(self, badge):
+        row = self.db.execute("SELECT id FROM people WHERE badge = ?",
+                (badge,)).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, badge, default=None):
+        id = self.lookup(badge)
+        return default if id is None else id
+
+    def __getitem__(self, badge):
+        id = self.lookup(badge)
+        if id is None:
+            raise KeyError(badge)
+        return id
+
+    def __contains__(self, badge):
+        return self.lookup(badge) is not None
+
+class TimeLogTable(object):
+    """List-like view of the unsynced time records."""
+
+    def __init__(self, store):
+        self.store = store
+        self.db = store.db
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM time_records "
+                "WHERE synced = 0").fetchone()[0]
+
+    def __bool__(self):
+        return self.db.execute("SELECT 1 FROM time_records "
+                "WHERE synced = 0 LIMIT 1").fetchone() is not None
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def append(self, record):
+        """Insert completed record.  Committed by the following journal()
+        call on the store."""
+        self.db.execute("INSERT INTO time_records "
+                "(person, in_time, out_time, hours, recorded) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (record.person.id, record.inTime, record.outTime,
+                 record.hours, record.recorded))
+
+    def snapshot(self):
+        ids = [row[0] for row in self.db.execute("SELECT id FROM "
+                "time_records WHERE synced = 0 ORDER BY id")]
+        return TimeLogView(self.store, ids)
+
+class TimeLogView(object):
+    """Fixed sequence of time records, identified by row id.  Records are
+    only loaded from the database while being iterated."""
+
+    def __init__(self, store, ids):
+        self.store = store
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TimeLogView(self.store, self.ids[index])
+        return self.load([self.ids[index]])[0][1]
+
+    def __iter__(self):
+        for start in range(0, len(self.ids), FETCH_SIZE):
+            for id, record in self.load(self.ids[start:start+FETCH_SIZE]):
+                yield record
+
+    def loaded(self):
+        """Read the records.  Returns (view of just those that could be
+        read, list of them)."""
+        pairs = []
+        for start in range(0, len(self.ids), FETCH_SIZE):
+            pairs.extend(self.load(self.ids[start:start+FETCH_SIZE]))
+        return (TimeLogView(self.store, [id for id, record in pairs]),
+                [record for id, record in pairs])
+
+    def load(self, ids):
+        with self.store.locked():
+            if not ids:
+                return []
+            rows = self.store.db.execute("SELECT id, person, in_time, "
+                    "out_time, hours, recorded FROM time_records "
+                    "WHERE synced = 0 AND id IN (%s)" %
+                    ",".join("?" * len(ids)),
+                    ids).fetchall()
+            people = self.store.people
+            records = {}
+            for id, personId, inTime, outTime, hours, recorded in rows:
+                person = people.get(personId)
+                if person is None:
+                    # no longer on the roster; only the id is sent anyway
+                    person = Person(personId, "", True, "", 0, 0)
+                record = TimeRecord(person, inTime)
+                record.outTime = outTime
+                record.hours = hours
+                record.recorded = recorded
+                records[id] = record
+            return [(id, records[id]) for id in ids if id in records]
+
+class SqliteDataStore(DataStore):
+    """DataStore that keeps people and time records in SQLite.  Only the
+    clocked in records are held in memory; everything else is queried on
+    demand through the people, badgeToId and timeLog views."""
+
+    def __init__(self, backend, filename=DATABASE_FILE, **kwargs):
+        super(SqliteDataStore, self).__init__(backend, **kwargs)
+        self.filename = filename
+        self.db = None
+        self.dataVersion = None
+
+    def connect(self):
+        db = sqlite3.connect(self.filename,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        return db
+
+    @metrics.timed("datastore_load_seconds")
+    def load(self):
+        with self.locked():
+            if self.db is not None:
+                self.db.close()
+            fresh = not os.path.exists(self.filename)
+            self.db = self.connect()
+            self.clockedIn = {}
+            self.people = PeopleTable(self)
+            self.badgeToId = BadgeTable(self.db)
+            self.timeLog = TimeLogTable(self)
+            if fresh and os.path.exists(SNAPSHOT_FILE):
+                self.importPickle()
+            self.pruneSynced()
+            self.readState()
+            self.statusUpdate.emit(
+                    "Loaded %d people (%d clocked in) and %d time records." %
+                    (len(self.people), len(self.clockedIn),
+                     len(self.timeLog)))
+            self.statsChanged.emit(self.stats())
+
+    def readState(self):
+        """Read the parts of the store kept in memory."""
+        self.dataVersion = self.db.execute(
+                "PRAGMA data_version").fetchone()[0]
+        row = self.db.execute("SELECT value FROM meta "
+                "WHERE key = 'personListVersion'").fetchone()
+        self.personListVersion = None if row is None else \
+                pickle.loads(bytes(row[0]))
+
+        self.clockedIn = {}
+        rows = self.db.execute("SELECT c.person, c.in_time, %s "
+                "FROM clocked_in c LEFT JOIN people p ON p.id = c.person" %
+                ", ".join("p." + c for c in PERSON_COLUMNS.split(", ")))
+        for row in rows:
+            if row[2] is None:
+                # no longer on the roster, but still clocked in; their
+                # hours are still due (only the id is sent)
+                person = Person(row[0], "", True, "", 0, 0)
+            else:
+                person = personFromRow(row[2:])
+            self.clockedIn[person.id] = TimeRecord(person, row[1])
+
+    def refresh(self):
+        # SQLite itself keeps the tables consistent between processes;
+        # only what is cached in memory needs reading again
+        if self.db is None:
+            return
+        if self.db.execute("PRAGMA data_version").fetchone()[0] == \
+                self.dataVersion:
+            return
+        self.readState()
+        self.peopleSerial += 1
+        self.reloaded.emit()
+        self.statsChanged.emit(self.stats())
+
+    def importPickle(self):
+        """Populate a new database from an existing pickle data store."""
+        old = DataStore(self.backend)
+        old.load()
+        for person in old.people.values():
+            self.people.put(person)
+        for id, record in old.clockedIn.items():
+            self.db.execute("INSERT INTO clocked_in (person, in_time) "
+                    "VALUES (?, ?)", (id, record.inTime))
+        for record in old.timeLog:
+            self.timeLog.append(record)
+        self.db.commit()
+
+    def journal(self, *entries):
+        """Apply entries to the database (completed records have already
+        been inserted by timeLog.append) and commit."""
+        with self.locked():
+            for entry in entries:
+                if entry[0] == 'in':
+                    self.db.execute("INSERT OR REPLACE INTO clocked_in "
+                            "(person, in_time) VALUES (?, ?)", entry[1:])
+                elif entry[0] in ('out', 'clear'):
+                    self.db.execute("DELETE FROM clocked_in "
+                            "WHERE person = ?", (entry[1],))
+            with metrics.timer("journal_fsync_seconds"):
+                self.db.commit()
+
+    @metrics.timed("datastore_save_seconds")
+    def save(self):
+        # every change is committed as it happens
+        with self.locked():
+            if self.db is not None:
+                self.db.commit()
+
+    def updatePeople(self, newpeople, version=None):
+        with self.locked():
+            existing = {}
+            for row in self.db.execute("SELECT %s FROM people" %
+                    PERSON_COLUMNS):
+                existing[row[0]] = row
+            updated = []
+            changed = []
+            for person in newpeople:
+                row = (person.id, person.name, int(person.student),
+                        person.photoRemote, person.photoSize, person.badge)
+                old = existing.pop(person.id, None)
+                if old == row:
+                    continue
+                self.people.put(person)
+                updated.append(person)
+                if old is not None:
+                    changed.append(person.id)
+                    record = self.clockedIn.get(person.id)
+                    if record is not None:
+                        record.person.updateFrom(person)
+            # whoever is left is no longer listed
+            self.db.executemany("DELETE FROM people WHERE id = ?",
+                    ((id,) for id in existing))
+            changed.extend(existing)
+            self.updateNameIndex(updated, existing)
+            self.personListVersion = version
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                    "VALUES ('personListVersion', ?)",
+                    (sqlite3.Binary(pickle.dumps(version)),))
+            self.db.commit()
+            return changed
+
+    def findPeople(self, text):
+        # searched in the database rather than an in-memory NameIndex,
+        # which would hold the whole roster
+        text = text.lower()
+        with self.locked():
+            return self.db.execute("SELECT name, badge FROM people "
+                    "WHERE instr(lower(name), ?) "
+                    "ORDER BY lower(name), name, badge, id",
+                    (text,)).fetchall()
+
+    def buildNameIndex(self):
+        pass # no in-memory index (see findPeople)
+
+    def pendingTimeRecords(self):
+        with self.locked():
+            return self.timeLog.snapshot()
+
+    def acknowledgeTimeRecords(self, pending, ok):
+        # pushed records are deleted (their space is reused by later ones)
+        with self.locked():
+            self.db.executemany("DELETE FROM time_records WHERE id = ?",
+                    ((pending.ids[i],) for i in ok))
+            self.db.commit()
+
+    def pruneSynced(self):
+        """Delete pushed records kept (marked synced) by earlier versions,
+        and shrink the file they took up."""
+        if self.db.execute("SELECT 1 FROM time_records "
+                "WHERE synced = 1 LIMIT 1").fetchone() is None:
+            return
+        self.db.execute("DELETE FROM time_records WHERE synced = 1")
+        self.db.commit()
+        self.db.execute("VACUUM")
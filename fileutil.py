@@ -0,0 +1,125 @@
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+def replaceFile(src, dst):
+    """Atomically replace dst with src (where the platform permits)."""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # Python 2 can't rename over an existing file on Windows
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+@contextmanager
+def atomicWrite(filename, mode="wb"):
+    """Open a temporary file next to filename for writing.  It is renamed
+    over filename only if the with block completes, so readers never see a
+    partially written file."""
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+            prefix=".tmp-")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        replaceFile(tmpName, filename)
+    except:
+        os.remove(tmpName)
+        raise
+
+def statSignature(filename):
+    """Identifies the current version of filename (None if it doesn't
+    exist), to tell cheaply whether another process has replaced it."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+class FileLock(object):
+    """Exclusive lock on filename, shared between processes (advisory on
+    Unix).  Reentrant for the thread holding it.  Use getFileLock() so that
+    everything in a process locking the same file shares one FileLock."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.threadLock = threading.RLock()
+        self.count = 0
+
+    def acquire(self, blocking=True):
+        """Take the lock.  Returns False if blocking is False and another
+        thread or process holds it."""
+        if not self.threadLock.acquire(blocking):
+            return False
+        if self.count == 0:
+            try:
+                if not self.lockFile(blocking):
+                    self.threadLock.release()
+                    return False
+            except:
+                self.threadLock.release()
+                raise
+        self.count += 1
+        return True
+
+    def release(self):
+        self.count -= 1
+        if self.count == 0:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.threadLock.release()
+
+    def lockFile(self, blocking):
+        if self.file is None:
+            self.file = open(self.filename, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(),
+                        fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                self.file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except IOError:
+                        if not blocking:
+                            raise
+                        time.sleep(0.05)
+        except (IOError, OSError):
+            if blocking:
+                raise
+            return False
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+fileLocks = {}
+fileLocksLock = threading.Lock()
+
+def getFileLock(filename):
+    """Returns the FileLock for filename, creating it if needed."""
+    with fileLocksLock:
+        key = os.path.abspath(filename)
+        lock = fileLocks.get(key)
+        if lock is None:
+            lock = fileLocks[key] = FileLock(filename)
+        return lock
@@ -4,6 +4,38 @@ from PyQt4.QtGui import *
 
 MAC = "qt_mac_set_native_menubar" in dir()
 
+class PersonTableModel(QAbstractTableModel):
+    """Read-only table of (name, badge) search results."""
+    headers = ["Name", "Badge"]
+
+    def __init__(self, parent=None):
+        super(PersonTableModel, self).__init__(parent)
+        self.rows = []
+
+    def setRows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        value = self.rows[index.row()][index.column()]
+        return value if index.column() == 0 else str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.headers[section]
+        return str(section + 1)
+
 class FindDlg(QDialog):
     personInOut = pyqtSignal([int])
 
@@ -15,9 +47,10 @@ class FindDlg(QDialog):
         self.findLineEdit = QLineEdit()
         findLabel.setBuddy(self.findLineEdit)
 
-        self.results = QTableWidget()
-        self.results.setColumnCount(2)
-        self.results.setHorizontalHeaderLabels(["Name", "Badge"])
+        self.model = PersonTableModel(self)
+        self.results = QTableView()
+        self.results.setModel(self.model)
+        self.results.setSelectionBehavior(QAbstractItemView.SelectRows)
 
         findButton = QPushButton("&Find")
         closeButton = QPushButton("&Close")
@@ -35,32 +68,18 @@ class FindDlg(QDialog):
 
         findButton.clicked.connect(self.find)
         self.findLineEdit.returnPressed.connect(self.find)
+        self.findLineEdit.textChanged.connect(self.find)
         closeButton.clicked.connect(self.close)
-        self.results.cellDoubleClicked.connect(self.resultDoubleClicked)
+        self.results.doubleClicked.connect(self.resultDoubleClicked)
 
         self.setWindowTitle("Find User")
 
     def find(self):
-        text = str(self.findLineEdit.text()).lower()
-        people = [p for p in self.datastore.people.values() if
-                text in p.name.lower()]
-        print("found %d results for '%s'" % (len(people), text))
-        self.results.clearContents()
-        self.results.setSortingEnabled(False)
-        self.results.setRowCount(len(people))
-        for row, person in enumerate(people):
-            item = QTableWidgetItem(person.name)
-            item.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-            self.results.setItem(row, 0, item)
-
-            item = QTableWidgetItem(str(person.badge))
-            item.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-            self.results.setItem(row, 1, item)
-        self.results.sortItems(0)
-
-    def resultDoubleClicked(self, row, column):
-        item = self.results.item(row, 1)
-        self.personInOut.emit(int(item.text()))
+        text = str(self.findLineEdit.text())
+        self.model.setRows(self.datastore.findPeople(text))
+
+    def resultDoubleClicked(self, index):
+        self.personInOut.emit(self.model.rows[index.row()][1])
 
 if __name__ == "__main__":
     import sys
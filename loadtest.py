@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Time DataStore.sync against a local stand-in Roster server.
+
+Starts rosterserver.py's server in-process, then from a scratch directory
+runs the roster backend through a sequence of syncs:
+
+    initial   empty store: fetch the roster and every photo
+    push      upload --records completed time records
+    edited    --changed people renamed with new photos on the server
+    idle      nothing changed
+
+For each the wall time, round trips and bytes (per endpoint, as seen by
+the server) and the client's own metrics are reported as JSON, so sync
+changes can be measured without a live Roster:
+
+    python loadtest.py --people 2000 --records 5000 --latency 0.02
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import backend_roster
+import datastore
+import rosterserver
+from benchmark import Quiet, addTimeLog, gitCommit
+from metrics import metrics
+
+# Client metrics included in the report
+CLIENT_COUNTERS = ("backend_bytes_received_total", "backend_bytes_sent_total",
+        "backend_compression_fallbacks_total",
+        "photo_download_failures_total", "upload_failures_total")
+CLIENT_TIMINGS = ("backend_login_seconds", "backend_get_person_list_seconds",
+        "backend_get_badge_photo_seconds", "backend_put_time_records_seconds")
+
+def rosterConfig(server, args):
+    config = ConfigParser()
+    config.add_section('global')
+    for name, value in (('PHOTO_WORKERS', args.photo_workers),
+            ('PHOTO_RETRIES', args.photo_retries),
+            ('UPLOAD_BATCH_SIZE', args.batch_size),
+            ('UPLOAD_CONCURRENCY', args.concurrency),
+            ('STORAGE', args.storage), ('JOURNAL_CHECKPOINT', 1000)):
+        config.set('global', name, str(value))
+    roster = server.roster
+    config.add_section('roster')
+    for name, value in (('BASE_URL', server.url()),
+            ('BASE_LOCATION', roster.base),
+            ('LOGIN_LOCATION', roster.loginLocation),
+            ('SIGNIN_PERSON_LIST_LOCATION', roster.personListLocation),
+            ('TIME_RECORD_BULK_ADD_LOCATION', roster.bulkAddLocation),
+            ('LOGIN_USERNAME', "signin"),
+            ('LOGIN_PASSWORD', rosterserver.PASSWORD),
+            ('COMPRESS', str(args.compress))):
+        config.set('roster', name, value)
+    return config
+
+def clientMetrics():
+    """Client metrics since the last call (which resets them)."""
+    with metrics.lock:
+        counters = dict((name, metrics.counters.get(name, 0))
+                for name in CLIENT_COUNTERS)
+        timings = {}
+        for name in CLIENT_TIMINGS:
+            histogram = metrics.histograms.get(name)
+            if histogram is not None:
+                timings[name] = dict(count=histogram.count,
+                        sum=histogram.sum, max=histogram.max)
+        metrics.counters.clear()
+        metrics.histograms.clear()
+    return dict(counters=counters, timings=timings)
+
+def timeSync(store, server):
+    server.roster.takeStats()
+    clientMetrics()
+    messages = []
+    store.statusUpdate.connect(messages.append)
+    start = time.time()
+    store.sync()
+    wall = time.time() - start
+    store.statusUpdate.disconnect(messages.append)
+    endpoints = server.roster.takeStats()
+    return dict(wall=wall, endpoints=endpoints,
+            roundTrips=sum(e['requests'] for e in endpoints.values()),
+            bytesUploaded=sum(e['bytesIn'] for e in endpoints.values()),
+            bytesDownloaded=sum(e['bytesOut'] for e in endpoints.values()),
+            client=clientMetrics(), status=messages[-1] if messages else None)
+
+def run(args):
+    server = rosterserver.RosterServer(rosterserver.rosterFromArguments(args))
+    server.start()
+    try:
+        config = rosterConfig(server, args)
+        store = datastore.fromConfig(config, backend_roster.Backend(config))
+        os.mkdir("photos")
+        store.load()
+        results = {}
+        results['initial'] = timeSync(store, server)
+        addTimeLog(store, args.records, random.Random(294))
+        results['push'] = timeSync(store, server)
+        results['push']['recordsReceived'] = len(server.roster.records)
+        server.roster.changePeople(min(args.changed, args.people))
+        results['edited'] = timeSync(store, server)
+        results['idle'] = timeSync(store, server)
+        results['pendingAfter'] = len(store.timeLog)
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    rosterserver.addArguments(parser)
+    parser.add_argument("--records", type=int, default=1000,
+            help="time records to push (default %(default)s)")
+    parser.add_argument("--changed", type=int, default=10,
+            help="people changed on the server before the edited sync")
+    parser.add_argument("--storage", choices=("pickle", "sqlite"),
+            default="pickle")
+    parser.add_argument("--no-compress", dest="compress",
+            action="store_false", help="set COMPRESS = no for the client")
+    parser.add_argument("--photo-workers", type=int, default=4)
+    parser.add_argument("--photo-retries", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=200,
+            help="UPLOAD_BATCH_SIZE (default %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=2,
+            help="UPLOAD_CONCURRENCY (default %(default)s)")
+    parser.add_argument("-o", "--output",
+            help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    report = dict(commit=gitCommit(), python=platform.python_version(),
+            platform=platform.platform(), date=datetime.now().isoformat(),
+            options=vars(args))
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="signinload")
+    os.chdir(scratch)
+    try:
+        with Quiet():
+            report['results'] = run(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == "__main__":
+    main()
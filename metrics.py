@@ -0,0 +1,162 @@
+"""Operation timings, counts and sizes, for diagnosing slowdowns after the
+fact.  Everything is recorded in the shared metrics object and can be
+written out as Prometheus text or JSON:
+
+    with metrics.timer("datastore_save_seconds"):
+        ...
+    metrics.count("backend_bytes_received_total", len(data))
+    metrics.write("metrics.prom")
+"""
+import bisect
+import functools
+import json
+import threading
+import time
+from fileutil import atomicWrite
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefix for names in Prometheus output
+PREFIX = "signin_"
+
+class Histogram(object):
+    """Distribution of observed durations (in seconds)."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # last is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Approximate q quantile: the upper bound of the bucket containing
+        it (or the largest value seen if beyond the last bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Timer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.start)
+
+class Metrics(object):
+    """Thread safe collection of named histograms and counters.  Histogram
+    names should end in _seconds and counter names in _total."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, name):
+        """Context manager recording the duration of its block in name."""
+        return Timer(self, name)
+
+    def timed(self, name):
+        """Decorator recording the duration of each call in name."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Timer(self, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def histogram(self, name):
+        with self.lock:
+            return self.histograms.get(name) or Histogram()
+
+    def toPrometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += n
+                    lines.append('%s%s_bucket{le="%s"} %d' %
+                            (PREFIX, name, bound, cumulative))
+                lines.append("%s%s_sum %r" % (PREFIX, name, histogram.sum))
+                lines.append("%s%s_count %d" %
+                        (PREFIX, name, histogram.count))
+            for name in sorted(self.counters):
+                lines.append("# TYPE %s%s counter" % (PREFIX, name))
+                lines.append("%s%s %d" % (PREFIX, name, self.counters[name]))
+        return "\n".join(lines) + "\n"
+
+    def toJson(self):
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = dict(count=histogram.count,
+                        sum=histogram.sum, max=histogram.max,
+                        buckets=dict(zip([str(b) for b in BUCKETS] + ["+Inf"],
+                            histogram.counts)))
+            return json.dumps(dict(time=time.time(), histograms=histograms,
+                counters=dict(self.counters)), indent=2, sort_keys=True)
+
+    def write(self, filename):
+        """Write all metrics to filename; as JSON if it ends in .json,
+        otherwise in the Prometheus text format."""
+        if filename.endswith(".json"):
+            data = self.toJson()
+        else:
+            data = self.toPrometheus()
+        with atomicWrite(filename) as f:
+            f.write(data.encode('utf-8'))
+
+    def summary(self):
+        """Short summary of the most useful timings for the status bar."""
+        parts = []
+        for label, name in (("scan", "datastore_sign_in_out_seconds"),
+                ("save", "datastore_save_seconds"),
+                ("sync", "datastore_sync_seconds"),
+                ("lock wait", "datastore_mutex_wait_seconds")):
+            histogram = self.histogram(name)
+            if histogram.count:
+                parts.append("%s p95 %s" % (label,
+                    formatSeconds(histogram.quantile(0.95))))
+        return ", ".join(parts)
+
+def formatSeconds(seconds):
+    if seconds < 0.01:
+        return "%.1fms" % (seconds * 1000)
+    if seconds < 1:
+        return "%dms" % round(seconds * 1000)
+    return "%.1fs" % seconds
+
+metrics = Metrics()
@@ -1,42 +1,41 @@
 from __future__ import print_function
 from datetime import datetime
-import os
-from PyQt4.QtCore import QObject, pyqtSignal
 
-class SuperQObject(QObject):
-    """ Permits the use of super() in class hierarchies that contain QObject.
+# Code39 characters, in checksum order
+CODE39_CHARSET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ-. $/+%"
 
-    Unlike QObject, SuperQObject does not accept a QObject parent. If it did,
-    super could not be emulated properly (all other classes in the hierarchy
-    would have to accept the parent argument--they don't, of course, because
-    they don't inherit QObject.)
-    """
-
-    def __new__(cls, *args, **kw):
-        # We initialize QObject as early as possible. Without this, Qt complains
-        # if SuperQObject is not the first class in the super class list.
-        inst = QObject.__new__(cls)
-        QObject.__init__(inst)
-        return inst
-
-    def __init__(self, *args, **kw):
-        # Emulate super by calling the next method in the MRO, if there is one.
-        mro = self.__class__.mro()
-        for qt_class in QObject.mro():
-            mro.remove(qt_class)
-        next_index = mro.index(SuperQObject) + 1
-        if next_index < len(mro):
-            mro[next_index].__init__(self, *args, **kw)
-
-class Person(SuperQObject):
-    updated = pyqtSignal()
+def parseBadge(text):
+    """Badge number from text typed or scanned at the kiosk: either the
+    number itself or a Code39 barcode "BxxxxC" (C=checksum).  Raises
+    ValueError with a message suitable for the status bar if invalid.
+    Surrounding whitespace isn't removed, as the checksum may be a space."""
+    if text.startswith('B'):
+        # Check checksum across all characters
+        try:
+            checksum = CODE39_CHARSET[sum(CODE39_CHARSET.index(c)
+                for c in text[:-1]) % 43]
+        except ValueError:
+            raise ValueError("Invalid barcode '%s'" % text)
+        if checksum != text[-1]:
+            raise ValueError("Bad barcode checksum for '%s': expected %s" %
+                    (text, checksum))
+        # Extract internal data (should be number)
+        text = text[1:-1]
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError("Invalid data entry '%s'" % text)
+
+class Person(object):
+    """A person on the roster.  Change notification is done by DataStore
+    (see DataStore.peopleUpdated) rather than per object, so these stay
+    cheap to create and store in bulk."""
+    __slots__ = ('id', 'name', 'student', 'photoRemote', 'photoSize', 'badge')
 
     def __init__(self, id, name, student, photoPath, photoSize, badge):
-        super(Person, self).__init__()
         self.id = id
         self.name = name
         self.student = student
-        self.photo = "photos/"+photoPath.split('/')[-1]
         self.photoRemote = photoPath
         self.photoSize = photoSize
         self.badge = badge
@@ -45,30 +44,19 @@ class Person(SuperQObject):
         return (Person, (self.id, self.name, self.student, self.photoRemote, self.photoSize, self.badge))
 
     def updateFrom(self, other):
+        """Copy other's details.  Returns True if anything changed."""
         assert(self.id == other.id)
         changed = (self.name != other.name or
                 self.student != other.student or
-                self.photo != other.photo or
                 self.photoRemote != other.photoRemote or
                 self.photoSize != other.photoSize or
                 self.badge != other.badge)
         self.name = other.name
         self.student = other.student
-        self.photo = other.photo
         self.photoRemote = other.photoRemote
         self.photoSize = other.photoSize
         self.badge = other.badge
-        if changed:
-            self.updated.emit()
-
-    def hasPhoto(self):
-        if self.photoSize == 0:
-            return False
-        try:
-            size = os.stat(self.photo).st_size
-        except OSError:
-            return False
-        return size == self.photoSize
+        return changed
 
     def __repr__(self):
         return 'Person(%s, %s, %s, %s, %s, %s)' % \
@@ -78,42 +66,49 @@ class Person(SuperQObject):
     def __str__(self):
         return "%s (%d)" % (self.name, self.badge)
 
-class TimeRecord(SuperQObject):
-    completed = pyqtSignal()
+class TimeRecord(object):
+    """Time a person was clocked in.  signOut() and clear() return True if
+    the record was completed by the call; DataStore is responsible for
+    announcing that (see DataStore.recordsChanged)."""
+    __slots__ = ('person', 'inTime', 'outTime', 'hours', 'recorded')
 
-    def __init__(self, person):
-        super(TimeRecord, self).__init__()
+    def __init__(self, person, inTime=None):
         self.person = person
-        self.inTime = datetime.now()
+        self.inTime = datetime.now() if inTime is None else inTime
         self.outTime = None
         self.hours = 0.0
         self.recorded = None
-        print("%s signed in" % self.person)
 
     def __reduce__(self):
+        # Same form as when TimeRecord was a QObject, so existing pickles
+        # still load
         return (TimeRecord, (self.person,),
                 {'inTime': self.inTime,
                     'outTime': self.outTime,
                     'hours': self.hours,
                     'recorded': self.recorded})
 
-    def signOut(self):
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def signOut(self, outTime=None):
         print("%s signing out" % self.person)
         if self.recorded is not None:
             print("already recorded")
-            return
-        self.outTime = datetime.now()
+            return False
+        self.outTime = datetime.now() if outTime is None else outTime
         self.hours = round((self.outTime - self.inTime).total_seconds() / 3600.0, 2)
         self.recorded = datetime.now()
-        self.completed.emit()
+        return True
 
     def clear(self):
         print("%s cleared" % self.person)
         if self.recorded is not None:
             print("already recorded")
-            return
+            return False
         self.outTime = self.inTime
         self.hours = 0.0
         self.recorded = datetime.now()
-        self.completed.emit()
+        return True
 
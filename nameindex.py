@@ -0,0 +1,100 @@
+import bisect
+
+class NameIndex(object):
+    """Index for case-insensitive substring search of people's names.
+
+    Names are broken into character trigrams; a query of three or more
+    characters only needs to check names containing all of its trigrams.
+    Shorter queries are searched for in a single string of all the names
+    (in sorted order), which is much faster than a loop over the names."""
+
+    def __init__(self, people=()):
+        self.entries = {} # id -> (lowercase name, name, badge, id)
+        self.grams = {} # trigram -> set of ids
+        self.order = None # (name, badge) sorted by name; None if out of date
+        self.names = "" # lowercase names in same order, newline separated
+        self.offsets = [] # start of each name within self.names
+        self.letters = {} # cached results for single letter queries
+        for person in people:
+            self.add(person)
+
+    @staticmethod
+    def trigrams(text):
+        return set(text[i:i+3] for i in range(len(text) - 2))
+
+    def add(self, person):
+        """Add person, or update them if already present."""
+        self.remove(person.id)
+        entry = (person.name.lower(), person.name, person.badge, person.id)
+        self.entries[person.id] = entry
+        for gram in self.trigrams(entry[0]):
+            self.grams.setdefault(gram, set()).add(person.id)
+        self.order = None
+
+    def remove(self, id):
+        entry = self.entries.pop(id, None)
+        if entry is None:
+            return
+        for gram in self.trigrams(entry[0]):
+            ids = self.grams[gram]
+            ids.discard(id)
+            if not ids:
+                del self.grams[gram]
+        self.order = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sort(self):
+        entries = sorted(self.entries.values())
+        self.order = [(e[1], e[2]) for e in entries]
+        self.offsets = []
+        offset = 0
+        for e in entries:
+            self.offsets.append(offset)
+            offset += len(e[0]) + 1
+        self.names = "".join(e[0] + "\n" for e in entries)
+        self.letters = {}
+
+    def scan(self, text):
+        if self.order is None:
+            self.sort()
+        if not text:
+            return list(self.order)
+        if len(text) == 1:
+            # these match a large fraction of all names; remember them
+            if text not in self.letters:
+                self.letters[text] = self.scanNames(text)
+            return list(self.letters[text])
+        return self.scanNames(text)
+
+    def scanNames(self, text):
+        matches = []
+        names, offsets = self.names, self.offsets
+        pos = names.find(text)
+        while pos >= 0:
+            i = bisect.bisect_right(offsets, pos) - 1
+            matches.append(self.order[i])
+            if i + 1 == len(offsets):
+                break
+            pos = names.find(text, offsets[i+1])
+        return matches
+
+    def find(self, text):
+        """Returns list of (name, badge) for people whose name contains
+        text, sorted by name."""
+        text = text.lower()
+        if "\n" in text:
+            return []
+        if len(text) < 3:
+            return self.scan(text)
+
+        candidates = None
+        for ids in sorted((self.grams.get(gram, ()) for gram in
+                self.trigrams(text)), key=len):
+            candidates = set(ids) if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        matches = sorted(e for e in (self.entries[id] for id in candidates)
+                if text in e[0])
+        return [(e[1], e[2]) for e in matches]
@@ -0,0 +1,207 @@
+"""Downloaded badge photos.
+
+Photos are stored under the SHA1 of their content, so a photo shared by
+several people, or sent again unchanged, is only stored once.  The
+manifest records which stored file holds each backend photo (identified
+by its remote path and size, plus the backend's photoVersion for backends
+whose photos can be replaced in place) and the size and mtime of each
+stored file when it was hashed.  It is read once and then consulted in memory, so
+deciding whether a photo needs downloading or can be shown doesn't touch
+the disk.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+from fileutil import atomicWrite, replaceFile, statSignature
+from metrics import metrics
+
+PHOTO_DIR = "photos"
+CONTENT_DIR = os.path.join(PHOTO_DIR, "content")
+MANIFEST_FILE = os.path.join(PHOTO_DIR, "manifest.pickle")
+MANIFEST_VERSION = 1
+
+def fileDigest(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class PhotoManifest(object):
+    """Index of the stored photos.  Thread safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {} # (remote path, size): stored file name
+        self.files = {} # stored file name: (size, mtime)
+        self.versions = {} # (remote path, size): backend photo version
+        self.loaded = False
+        self.dirty = False
+        self.signature = None # of MANIFEST_FILE when last read or written
+
+    def refresh(self):
+        """Read the manifest if not yet read (checking the stored files are
+        unchanged), or if another process (e.g. the sync daemon) has
+        since written it.  Returns True in the latter case."""
+        signature = statSignature(MANIFEST_FILE)
+        with self.lock:
+            if self.loaded and signature == self.signature:
+                return False
+            reloaded = self.loaded
+            self.read(verify=not self.loaded)
+            return reloaded
+
+    def read(self, verify):
+        try:
+            with open(MANIFEST_FILE, "rb") as f:
+                state = pickle.load(f)
+            if state['version'] != MANIFEST_VERSION:
+                raise ValueError("unknown manifest version")
+            sources = state['sources']
+            files = state['files']
+            versions = state.get('versions', {})
+        except (IOError, EOFError, ValueError, KeyError,
+                pickle.UnpicklingError):
+            sources = {}
+            files = {}
+            versions = {}
+        self.signature = statSignature(MANIFEST_FILE)
+        if verify:
+            # forget files that were removed or changed behind our back
+            for name, (size, mtime) in list(files.items()):
+                try:
+                    st = os.stat(os.path.join(CONTENT_DIR, name))
+                except OSError:
+                    st = None
+                if st is None or (st.st_size, st.st_mtime) != (size, mtime):
+                    del files[name]
+                    self.dirty = True
+            sources = dict((key, name) for key, name in sources.items()
+                    if name in files)
+            versions = dict((key, version) for key, version in
+                    versions.items() if key in sources)
+        self.sources = sources
+        self.files = files
+        self.versions = versions
+        self.loaded = True
+
+    def save(self):
+        """Write the manifest if it has changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            with atomicWrite(MANIFEST_FILE) as f:
+                pickle.dump(dict(version=MANIFEST_VERSION,
+                    sources=self.sources, files=self.files,
+                    versions=self.versions), f,
+                    pickle.HIGHEST_PROTOCOL)
+            self.signature = statSignature(MANIFEST_FILE)
+            self.dirty = False
+
+    def lookup(self, remote, size):
+        """Stored file holding the photo, or None if it hasn't been
+        downloaded."""
+        with self.lock:
+            name = self.sources.get((remote, size))
+        return None if name is None else os.path.join(CONTENT_DIR, name)
+
+    def photoFile(self, person):
+        """Stored file for person's photo (None if they have none or it
+        hasn't been downloaded yet)."""
+        if not person.photoRemote or not person.photoSize:
+            return None
+        return self.lookup(person.photoRemote, person.photoSize)
+
+    def isCurrent(self, person, version):
+        """True if person's photo is stored and was the given version
+        (None for backends that don't report one) when stored."""
+        key = (person.photoRemote, person.photoSize)
+        with self.lock:
+            return key in self.sources and \
+                    self.versions.get(key) == version
+
+    def downloadName(self, person):
+        """Temporary file to download person's photo to before add()."""
+        if not os.path.isdir(CONTENT_DIR):
+            try:
+                os.makedirs(CONTENT_DIR)
+            except OSError:
+                pass # created by another thread
+        return os.path.join(CONTENT_DIR, ".download-%d" % person.id)
+
+    def add(self, remote, size, filename, version=None):
+        """Store the downloaded filename as the photo (remote, size) at the
+        backend's version: it is moved into place under its content hash,
+        or discarded if that content is already stored.  Returns the stored
+        file."""
+        extension = os.path.splitext(remote)[1].lower() or ".jpg"
+        name = fileDigest(filename) + extension
+        path = os.path.join(CONTENT_DIR, name)
+        with self.lock:
+            if name in self.files:
+                os.remove(filename)
+                metrics.count("photo_duplicates_total")
+            else:
+                replaceFile(filename, path)
+                st = os.stat(path)
+                self.files[name] = (st.st_size, st.st_mtime)
+            old = self.sources.get((remote, size))
+            self.sources[(remote, size)] = name
+            if version is None:
+                self.versions.pop((remote, size), None)
+            else:
+                self.versions[(remote, size)] = version
+            self.dirty = True
+            # the content replaced in place, if nothing else uses it
+            if old is None or old == name or old in self.sources.values():
+                old = None
+            else:
+                del self.files[old]
+        if old is not None:
+            try:
+                os.remove(os.path.join(CONTENT_DIR, old))
+            except OSError:
+                pass
+        return path
+
+    def adopt(self, person, version=None):
+        """Store person's photo from where it was downloaded to before
+        photos were stored by content, if it is there and the right size.
+        Returns the stored file, or None."""
+        legacy = os.path.join(PHOTO_DIR, person.photoRemote.split('/')[-1])
+        try:
+            if os.stat(legacy).st_size != person.photoSize:
+                return None
+        except OSError:
+            return None
+        # copied, as the csv backend's source photos may live there
+        filename = self.downloadName(person)
+        shutil.copyfile(legacy, filename)
+        return self.add(person.photoRemote, person.photoSize, filename,
+                version)
+
+    def prune(self, people):
+        """Forget photos no longer used by any of people (the whole
+        roster), deleting stored files nobody uses."""
+        keep = set((person.photoRemote, person.photoSize)
+                for person in people)
+        removed = []
+        with self.lock:
+            for key in list(self.sources):
+                if key not in keep:
+                    del self.sources[key]
+                    self.versions.pop(key, None)
+                    self.dirty = True
+            used = set(self.sources.values())
+            for name in list(self.files):
+                if name not in used:
+                    del self.files[name]
+                    removed.append(name)
+                    self.dirty = True
+        for name in removed:
+            try:
+                os.remove(os.path.join(CONTENT_DIR, name))
+            except OSError:
+                pass
@@ -0,0 +1,226 @@
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+
+class PresenceModel(QAbstractListModel):
+    """Clocked in records shown on one section of the presence board, in
+    the order they were added."""
+    RecordRole = Qt.UserRole
+
+    def __init__(self, photoFile, parent=None):
+        super(PresenceModel, self).__init__(parent)
+        self.photoFile = photoFile # person -> photo file or None
+        self.records = []
+        self.photos = {} # id -> photoFile(person) when last added/refreshed
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.records)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self.records[index.row()]
+        if role == Qt.DisplayRole:
+            return self.label(record)
+        elif role == Qt.ToolTipRole:
+            return str(record.person)
+        elif role == self.RecordRole:
+            return record
+        return None
+
+    def label(self, record):
+        return "%s (%d)" % (record.person.name.partition(' ')[0],
+                record.person.badge)
+
+    def row(self, id):
+        for row, record in enumerate(self.records):
+            if record.person.id == id:
+                return row
+        return -1
+
+    def __contains__(self, id):
+        return id in self.photos
+
+    def add(self, record):
+        row = len(self.records)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.records.append(record)
+        self.photos[record.person.id] = self.photoFile(record.person)
+        self.endInsertRows()
+
+    def addMany(self, records):
+        """Add records as one insertion."""
+        if not records:
+            return
+        row = len(self.records)
+        self.beginInsertRows(QModelIndex(), row, row + len(records) - 1)
+        for record in records:
+            self.records.append(record)
+            self.photos[record.person.id] = self.photoFile(record.person)
+        self.endInsertRows()
+
+    def remove(self, id):
+        """Remove record for id.  Returns the removed record (or None)."""
+        row = self.row(id)
+        if row < 0:
+            return None
+        self.beginRemoveRows(QModelIndex(), row, row)
+        record = self.records.pop(row)
+        del self.photos[id]
+        self.endRemoveRows()
+        return record
+
+    def removeMany(self, ids):
+        """Remove records for ids (those shown) as one reset of the model
+        rather than a removal per row."""
+        ids = set(ids) & set(self.photos)
+        if len(ids) <= 1:
+            for id in ids:
+                self.remove(id)
+            return
+        self.beginResetModel()
+        self.records = [record for record in self.records
+                if record.person.id not in ids]
+        for id in ids:
+            del self.photos[id]
+        self.endResetModel()
+
+    def replace(self, record):
+        """Hold record in place of the one shown for the same sign in
+        (e.g. reloaded from another process's checkpoint).  Nothing is
+        redrawn; call refresh() if its details differ."""
+        row = self.row(record.person.id)
+        if row >= 0:
+            self.records[row] = record
+
+    def refresh(self, id):
+        """Person details (or photo) for id changed."""
+        row = self.row(id)
+        if row < 0:
+            return
+        record = self.records[row]
+        self.photos[id] = self.photoFile(record.person)
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+class PresenceDelegate(QStyledItemDelegate):
+    """Draws a tile: the person's photo with their name beneath."""
+
+    def __init__(self, view):
+        super(PresenceDelegate, self).__init__(view)
+        self.view = view
+
+    def sizeHint(self, option, index):
+        return self.view.tileSize()
+
+    def paint(self, painter, option, index):
+        rect = option.rect.adjusted(2, 2, -2, -2)
+        painter.save()
+        painter.fillRect(rect, Qt.white)
+        painter.setPen(Qt.black)
+        painter.drawRect(rect.adjusted(0, 0, -1, -1))
+
+        model = index.model()
+        record = model.records[index.row()]
+        labelHeight = self.view.labelHeight()
+        photoRect = rect.adjusted(1, 1, -1, -labelHeight)
+        pixmap = None
+        photo = model.photos[record.person.id]
+        if photo is not None:
+            pixmap = self.view.pixmap(photo, photoRect.size())
+        if pixmap is None:
+            pixmap = self.view.placeholder(photoRect.size())
+        painter.drawPixmap(photoRect, pixmap, QRect(
+                (pixmap.width() - photoRect.width()) // 2,
+                (pixmap.height() - photoRect.height()) // 2,
+                photoRect.width(), photoRect.height()))
+
+        labelRect = QRect(rect.left(), rect.bottom() - labelHeight,
+                rect.width(), labelHeight)
+        painter.drawText(labelRect, Qt.AlignCenter, model.label(record))
+        painter.restore()
+
+class PresenceView(QListView):
+    """Scrolling grid of PresenceModel tiles, columns wide.  Photos are
+    only requested (through pixmapNeeded) for tiles that get painted, i.e.
+    the visible ones."""
+    pixmapNeeded = pyqtSignal(str, int, int)
+    noImage = QImage("photos/NO-IMAGE-AVAILABLE.jpg")
+
+    def __init__(self, model, columns, parent=None):
+        super(PresenceView, self).__init__(parent)
+        self.columns = columns
+        self.pixmaps = {} # filename -> QPixmap at current tile size
+        self.requested = set()
+        self.placeholders = {}
+        self.setModel(model)
+        self.setItemDelegate(PresenceDelegate(self))
+        self.setViewMode(QListView.IconMode)
+        self.setMovement(QListView.Static)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(True)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        model.rowsAboutToBeRemoved.connect(self.rowsRemoving)
+        model.dataChanged.connect(self.prunePixmaps)
+        model.modelReset.connect(self.prunePixmaps)
+
+    def labelHeight(self):
+        return int(self.fontMetrics().height() * 1.25)
+
+    def tileSize(self):
+        width = max(60, self.viewport().width() // self.columns)
+        return QSize(width, int(width * 1.25) + self.labelHeight())
+
+    def resizeEvent(self, event):
+        # tiles change size with the view; drop pixmaps at the old size
+        self.setGridSize(self.tileSize())
+        self.pixmaps.clear()
+        self.requested.clear()
+        self.placeholders.clear()
+        super(PresenceView, self).resizeEvent(event)
+
+    def placeholder(self, size):
+        key = (size.width(), size.height())
+        if key not in self.placeholders:
+            self.placeholders[key] = QPixmap.fromImage(self.noImage.scaled(
+                    size, Qt.KeepAspectRatioByExpanding,
+                    Qt.SmoothTransformation))
+        return self.placeholders[key]
+
+    def pixmap(self, filename, size):
+        """Returns pixmap for filename if loaded, otherwise requests it
+        and returns None."""
+        pixmap = self.pixmaps.get(filename)
+        if pixmap is None and filename not in self.requested:
+            self.requested.add(filename)
+            self.pixmapNeeded.emit(filename, size.width(), size.height())
+        return pixmap
+
+    def setPixmap(self, filename, image):
+        """Loaded image for filename (if this view asked for it)."""
+        filename = str(filename)
+        if filename not in self.requested:
+            return
+        self.pixmaps[filename] = QPixmap.fromImage(image)
+        self.viewport().update()
+
+    def forget(self, filename):
+        self.pixmaps.pop(filename, None)
+        self.requested.discard(filename)
+
+    def rowsRemoving(self, parent, first, last):
+        model = self.model()
+        for row in range(first, last + 1):
+            self.forget(model.photos[model.records[row].person.id])
+
+    def prunePixmaps(self, *args):
+        # photos are stored by content, so a changed photo has a new file
+        # name; drop pixmaps of files no longer shown (also after a reset,
+        # which doesn't announce the rows it removed)
+        shown = set(self.model().photos.values())
+        for filename in list(self.pixmaps) + list(self.requested):
+            if filename not in shown:
+                self.forget(filename)
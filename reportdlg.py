@@ -0,0 +1,125 @@
+import csv
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+import reports
+
+MAC = "qt_mac_set_native_menubar" in dir()
+
+class ReportTableModel(QAbstractTableModel):
+    """Read-only table of report rows (the first row is the header)."""
+
+    def __init__(self, parent=None):
+        super(ReportTableModel, self).__init__(parent)
+        self.headers = []
+        self.rows = []
+
+    def setRows(self, rows):
+        self.beginResetModel()
+        self.headers = rows[0]
+        self.rows = rows[1:]
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        value = self.rows[index.row()][index.column()]
+        if role == Qt.DisplayRole:
+            return str(value)
+        if role == Qt.TextAlignmentRole and isinstance(value, (int, float)):
+            return Qt.AlignRight|Qt.AlignVCenter
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.headers[section]
+        return str(section + 1)
+
+class ReportDlg(QDialog):
+    def __init__(self, filename, parent=None):
+        super(ReportDlg, self).__init__(parent)
+        self.filename = filename
+        self.report = None
+
+        byLabel = QLabel("&Hours by:")
+        self.byCombo = QComboBox()
+        self.byCombo.addItems(list(reports.REPORTS))
+        byLabel.setBuddy(self.byCombo)
+
+        self.model = ReportTableModel(self)
+        self.results = QTableView()
+        self.results.setModel(self.model)
+        self.results.setSelectionBehavior(QAbstractItemView.SelectRows)
+
+        refreshButton = QPushButton("&Refresh")
+        saveButton = QPushButton("&Save As...")
+        closeButton = QPushButton("&Close")
+        if not MAC:
+            refreshButton.setFocusPolicy(Qt.NoFocus)
+            saveButton.setFocusPolicy(Qt.NoFocus)
+            closeButton.setFocusPolicy(Qt.NoFocus)
+
+        gridLayout = QGridLayout()
+        gridLayout.addWidget(byLabel, 0, 0)
+        gridLayout.addWidget(self.byCombo, 0, 1)
+        gridLayout.addWidget(refreshButton, 0, 2)
+        gridLayout.addWidget(saveButton, 0, 3)
+        gridLayout.addWidget(closeButton, 0, 4)
+        gridLayout.addWidget(self.results, 1, 0, 1, -1)
+        self.setLayout(gridLayout)
+
+        self.byCombo.currentIndexChanged.connect(self.showReport)
+        refreshButton.clicked.connect(self.refresh)
+        saveButton.clicked.connect(self.save)
+        closeButton.clicked.connect(self.close)
+
+        self.setWindowTitle("Hours Report")
+        self.resize(600, 500)
+        self.refresh()
+
+    def refresh(self):
+        """Bring the totals up to date with the records file (only rows
+        added since the last report are read)."""
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            self.report = reports.loadReport(self.filename)
+        except IOError as e:
+            self.report = None
+            QMessageBox.warning(self, "Hours Report",
+                    "Unable to read %s: %s" % (self.filename, e))
+        finally:
+            QApplication.restoreOverrideCursor()
+        self.showReport()
+
+    def showReport(self):
+        if self.report is None:
+            return
+        by = str(self.byCombo.currentText())
+        self.model.setRows(self.report.rows(by))
+        self.results.resizeColumnsToContents()
+
+    def save(self):
+        if self.report is None:
+            return
+        filename = QFileDialog.getSaveFileName(self, "Save Report",
+                "hours-%s.csv" % self.byCombo.currentText(),
+                "CSV files (*.csv)")
+        if not filename:
+            return
+        with open(str(filename), "w") as f:
+            csv.writer(f).writerows(
+                    self.report.rows(str(self.byCombo.currentText())))
+
+if __name__ == "__main__":
+    import sys
+    app = QApplication(sys.argv)
+    form = ReportDlg(sys.argv[1] if len(sys.argv) > 1 else "records.csv")
+    form.show()
+    app.exec_()
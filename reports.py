@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""Hours reports from the csv backend's records file.
+
+The records file is only ever appended to, so the totals are kept in a
+cache next to it (RECORDS_FILE plus ".report") along with how far into the
+file they go; each run only reads the rows added since.  Rows are read in
+chunks and split into columns (person, day, hours) before being summed:
+
+    python reports.py --by week
+    python reports.py --by person --csv > hours.csv
+"""
+from __future__ import print_function
+import argparse
+import csv
+import os
+import pickle
+import sys
+from array import array
+from datetime import date, timedelta
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+from fileutil import atomicWrite
+from metrics import metrics
+
+# Bytes of the records file read at a time
+CHUNK_SIZE = 1 << 20
+# Bytes before the cached offset that must be unchanged to trust the cache
+CHECK_SIZE = 256
+CACHE_VERSION = 1
+
+REPORTS = ("person", "day", "week", "person-week")
+
+class Columns(object):
+    """One chunk of rows, column by column.  Days are date ordinals."""
+
+    def __init__(self):
+        self.ids = array('l')
+        self.days = array('l')
+        self.hours = array('d')
+
+    def __len__(self):
+        return len(self.ids)
+
+class HoursReport(object):
+    """Hours per person, per day, per week (starting Monday) and per person
+    per week, summed over a records file."""
+
+    def __init__(self):
+        self.offset = 0 # bytes of the records file included
+        self.check = b"" # the CHECK_SIZE bytes before offset
+        self.names = {} # id: (name, student)
+        self.people = {} # id: [hours, records]
+        self.days = {} # day ordinal: [hours, records]
+        self.weeks = {} # ordinal of Monday: [hours, records]
+        self.personWeeks = {} # (id, ordinal of Monday): hours
+        self.dayCache = {} # Clocked In date string: day ordinal
+
+    def state(self):
+        return dict(version=CACHE_VERSION, offset=self.offset,
+                check=self.check, names=self.names, people=self.people,
+                days=self.days, weeks=self.weeks,
+                personWeeks=self.personWeeks)
+
+    @classmethod
+    def fromState(cls, state):
+        report = cls()
+        for name in ('offset', 'check', 'names', 'people', 'days', 'weeks',
+                'personWeeks'):
+            setattr(report, name, state[name])
+        return report
+
+    def dayOrdinal(self, text):
+        """Date ordinal of a "YYYY-MM-DD ..." date/time, or None."""
+        text = text[:10]
+        day = self.dayCache.get(text)
+        if day is None:
+            try:
+                day = date(int(text[0:4]), int(text[5:7]),
+                        int(text[8:10])).toordinal()
+            except ValueError:
+                return None
+            self.dayCache[text] = day
+        return day
+
+    def columns(self, rows):
+        """Split csv rows into Columns, skipping the header and any rows
+        that can't be parsed (e.g. hand edits)."""
+        columns = Columns()
+        for row in rows:
+            if len(row) < 7:
+                continue
+            try:
+                id = int(row[0])
+                hours = float(row[6])
+            except ValueError:
+                continue
+            day = self.dayOrdinal(row[4])
+            if day is None:
+                continue
+            columns.ids.append(id)
+            columns.days.append(day)
+            columns.hours.append(hours)
+            self.names[id] = (row[1], row[2])
+        return columns
+
+    def add(self, columns):
+        """Add a chunk's columns to the totals."""
+        weekdays = {}
+        weeks = array('l', [day - weekdays.setdefault(day, date.fromordinal(
+            day).weekday()) for day in columns.days])
+        for key, totals in ((columns.ids, self.people),
+                (columns.days, self.days), (weeks, self.weeks)):
+            for k, hours in zip(key, columns.hours):
+                total = totals.get(k)
+                if total is None:
+                    totals[k] = [hours, 1]
+                else:
+                    total[0] += hours
+                    total[1] += 1
+        personWeeks = self.personWeeks
+        for k, hours in zip(zip(columns.ids, weeks), columns.hours):
+            personWeeks[k] = personWeeks.get(k, 0.0) + hours
+
+    @metrics.timed("report_update_seconds")
+    def update(self, filename):
+        """Add the rows appended to filename since the last update.  A
+        trailing partial row (still being written) is left for next time.
+        Returns the number of rows added."""
+        added = 0
+        with open(filename, "rb") as f:
+            f.seek(self.offset)
+            remainder = b""
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                data = remainder + data
+                end = data.rfind(b"\n") + 1
+                remainder = data[end:]
+                data = data[:end]
+                if not data:
+                    continue
+                if bytes is not str:
+                    data = data.decode('utf-8', 'replace')
+                columns = self.columns(csv.reader(data.splitlines()))
+                self.add(columns)
+                added += len(columns)
+                self.offset += end
+        metrics.count("report_rows_total", added)
+        self.updateCheck(filename)
+        return added
+
+    def updateCheck(self, filename):
+        with open(filename, "rb") as f:
+            start = max(0, self.offset - CHECK_SIZE)
+            f.seek(start)
+            self.check = f.read(self.offset - start)
+
+    def matches(self, filename):
+        """Whether filename still starts with the rows summed so far."""
+        try:
+            with open(filename, "rb") as f:
+                start = max(0, self.offset - CHECK_SIZE)
+                f.seek(start)
+                return f.read(self.offset - start) == self.check
+        except IOError:
+            return False
+
+    def rows(self, by):
+        """Report rows (with a header row first), sorted."""
+        if by == "person":
+            rows = [["ID", "Name", "Student?", "Hours", "Records"]]
+            for id in sorted(self.people):
+                name, student = self.names.get(id, ("", ""))
+                hours, count = self.people[id]
+                rows.append([id, name, student, round(hours, 2), count])
+        elif by == "day":
+            rows = [["Date", "Hours", "Records"]]
+            for day in sorted(self.days):
+                hours, count = self.days[day]
+                rows.append([date.fromordinal(day).isoformat(),
+                    round(hours, 2), count])
+        elif by == "week":
+            rows = [["Week Of", "Hours", "Records"]]
+            for week in sorted(self.weeks):
+                hours, count = self.weeks[week]
+                rows.append([date.fromordinal(week).isoformat(),
+                    round(hours, 2), count])
+        elif by == "person-week":
+            rows = [["ID", "Name", "Week Of", "Hours"]]
+            for id, week in sorted(self.personWeeks):
+                rows.append([id, self.names.get(id, ("", ""))[0],
+                    date.fromordinal(week).isoformat(),
+                    round(self.personWeeks[id, week], 2)])
+        else:
+            raise ValueError("unknown report %r" % by)
+        return rows
+
+def cacheFilename(filename):
+    return filename + ".report"
+
+def loadReport(filename, useCache=True):
+    """HoursReport for the records file filename, brought up to date from
+    its cache (which is then rewritten)."""
+    cache = cacheFilename(filename)
+    report = None
+    if useCache:
+        try:
+            with open(cache, "rb") as f:
+                state = pickle.load(f)
+            if state.get('version') == CACHE_VERSION:
+                report = HoursReport.fromState(state)
+                if not report.matches(filename):
+                    report = None # records file replaced or truncated
+        except (IOError, EOFError, pickle.UnpicklingError, KeyError,
+                AttributeError):
+            report = None
+    if report is None:
+        report = HoursReport()
+    if report.update(filename) or not useCache or \
+            not os.path.exists(cache):
+        try:
+            with atomicWrite(cache) as f:
+                pickle.dump(report.state(), f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError):
+            pass # e.g. read-only directory; just slower next time
+    return report
+
+def formatTable(rows):
+    widths = [max(len(str(row[i])) for row in rows)
+            for i in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        lines.append("  ".join(str(value).rjust(width)
+            if isinstance(value, (int, float)) else str(value).ljust(width)
+            for value, width in zip(row, widths)).rstrip())
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("records", nargs="?",
+            help="records file (default RECORDS_FILE from settings.ini)")
+    parser.add_argument("--by", choices=REPORTS, default="person",
+            help="what to total hours by (default %(default)s)")
+    parser.add_argument("--since", help="only days from this date on "
+            "(YYYY-MM-DD); day and week reports only")
+    parser.add_argument("--csv", action="store_true",
+            help="write csv instead of a table")
+    parser.add_argument("--rebuild", action="store_true",
+            help="ignore the cache and reread the whole file")
+    args = parser.parse_args()
+
+    filename = args.records
+    if filename is None:
+        config = ConfigParser()
+        config.read("settings.ini")
+        filename = config.get('csv', 'RECORDS_FILE')
+    if not os.path.exists(filename):
+        parser.error("%s not found" % filename)
+
+    rows = loadReport(filename, not args.rebuild).rows(args.by)
+    if args.since:
+        if args.by not in ("day", "week"):
+            parser.error("--since only applies to --by day or week")
+        since = args.since
+        if args.by == "week":
+            day = date(*[int(x) for x in since.split("-")])
+            since = (day - timedelta(days=day.weekday())).isoformat()
+        rows = rows[:1] + [row for row in rows[1:] if row[0] >= since]
+
+    if args.csv:
+        csv.writer(sys.stdout).writerows(rows)
+    else:
+        print(formatTable(rows))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""Local stand-in for the Roster server, for testing and load testing.
+
+Implements just what backend_roster uses: the Django style login (csrftoken
+cookie, login form, session cookie, redirect to the login page when the
+session is missing or expired), the sign in person list (with ETag
+support), badge photos and the time record bulk add (answering with the
+accepted indices and then any errors).  The person list is gzipped for
+clients that accept it and gzipped uploads are accepted, unless --no-gzip
+is given to act like a server without compression support.  The roster is synthetic; latency
+and failures can be injected:
+
+    python rosterserver.py --port 8080 --people 2000 --latency 0.05
+
+then point settings.ini's BASE_URL at it (any username, password
+"signin").  See loadtest.py for timing syncs against it.
+"""
+from __future__ import print_function
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from http.cookies import SimpleCookie
+    from urllib.parse import parse_qsl, urlencode, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Cookie import SimpleCookie
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit
+
+LOGIN_PAGE = b"""<html><body><form method="post">
+<input name="username"><input name="password" type="password">
+<input type="submit" value="Log in"></form></body></html>
+"""
+
+PASSWORD = "signin"
+
+FIRST_NAMES = ["Alex", "Bailey", "Casey", "Dana", "Elliot", "Frankie",
+        "Gray", "Harper", "Indigo", "Jordan", "Kai", "Logan", "Morgan",
+        "Noel", "Oakley", "Parker", "Quinn", "Riley", "Sage", "Taylor"]
+LAST_NAMES = ["Anderson", "Brown", "Chen", "Davis", "Evans", "Garcia",
+        "Hughes", "Ito", "Johnson", "Kim", "Lopez", "Miller", "Nguyen",
+        "Okafor", "Patel", "Rossi", "Smith", "Tanaka", "Walker", "Young"]
+
+def compress(data):
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as out:
+        out.write(data)
+    return f.getvalue()
+
+class Roster(object):
+    """The server's state: a synthetic roster, sessions, received time
+    records and per endpoint request statistics.  Thread safe."""
+
+    def __init__(self, people=100, photoSize=20000, latency=0.0,
+            failRate=0.0, rejectRate=0.0, sessionRequests=0, gzip=True,
+            seed=294, base="/roster/"):
+        self.base = base
+        self.loginLocation = base + "login/"
+        self.personListLocation = base + "signin_person_list/"
+        self.bulkAddLocation = base + "time_record_bulk_add/"
+        self.photoLocation = base + "photos/"
+        self.photoSize = photoSize
+        self.latency = latency
+        self.failRate = failRate
+        self.rejectRate = rejectRate
+        self.sessionRequests = sessionRequests
+        self.gzip = gzip
+        self.lock = threading.Lock()
+        self.rand = random.Random(seed)
+        self.sessions = {} # session id: requests left (None for no limit)
+        self.people = {} # id: [name, student, badge, photo version]
+        self.records = [] # received rows
+        self.stats = {}
+        for id in range(1, people + 1):
+            self.people[id] = ["%s %s %d" % (self.rand.choice(FIRST_NAMES),
+                self.rand.choice(LAST_NAMES), id),
+                self.rand.random() >= 0.2, 10000 + id, 1]
+        self.buildPersonList()
+
+    def buildPersonList(self):
+        f = io.StringIO(newline="")
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "student", "photo", "photo size",
+            "badge"])
+        for id in sorted(self.people):
+            name, student, badge, version = self.people[id]
+            writer.writerow([id, name, student, self.photoPath(id, version),
+                self.photoSize, badge])
+        self.personList = f.getvalue().encode('utf-8')
+        self.personListGzip = compress(self.personList)
+        self.etag = '"%s"' % hashlib.sha1(self.personList).hexdigest()
+
+    def photoPath(self, id, version):
+        return "%s%d-%d.jpg" % (self.photoLocation, id, version)
+
+    def photo(self, name):
+        """Photo data for photo file name, or None if there is no such
+        photo."""
+        try:
+            id, version = [int(x) for x in name[:-len(".jpg")].split("-")]
+        except ValueError:
+            return None
+        with self.lock:
+            if self.people.get(id, [None] * 4)[3] != version:
+                return None
+        seed = hashlib.sha1(name.encode('utf-8')).digest()
+        return (seed * (self.photoSize // len(seed) + 1))[:self.photoSize]
+
+    def changePeople(self, count):
+        """Rename count random people and give them new photos (as if the
+        roster had been edited)."""
+        with self.lock:
+            for id in self.rand.sample(sorted(self.people), count):
+                person = self.people[id]
+                person[0] += " Jr"
+                person[3] += 1
+            self.buildPersonList()
+
+    def newSession(self):
+        session = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session] = self.sessionRequests or None
+        return session
+
+    def useSession(self, session):
+        """Whether session is logged in (using up one of its requests if
+        sessions are limited)."""
+        with self.lock:
+            if session not in self.sessions:
+                return False
+            left = self.sessions[session]
+            if left is not None:
+                if left <= 0:
+                    del self.sessions[session]
+                    return False
+                self.sessions[session] = left - 1
+            return True
+
+    def shouldFail(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.rand.random() < rate
+
+    def addRecords(self, data):
+        """Handle a bulk add of a csv of time records.  Returns the response
+        body: the list of accepted row indices, a newline, then any
+        errors."""
+        reader = csv.DictReader(io.StringIO(data.decode('utf-8'),
+            newline=""))
+        ok = []
+        errors = []
+        rows = []
+        for i, row in enumerate(reader):
+            try:
+                person = int(row["person"])
+                datetime.strptime(row["clock_in"][:19], "%Y-%m-%d %H:%M:%S")
+                float(row["hours"])
+            except (KeyError, ValueError) as e:
+                errors.append("row %d: invalid: %s" % (i, e))
+                continue
+            if person not in self.people:
+                errors.append("row %d: no person %d" % (i, person))
+                continue
+            if self.shouldFail(self.rejectRate):
+                errors.append("row %d: rejected (injected)" % i)
+                continue
+            ok.append(i)
+            rows.append(row)
+        with self.lock:
+            self.records.extend(rows)
+        return (str(ok) + "\n" + "\n".join(errors)).encode('utf-8')
+
+    def count(self, endpoint, received, sent):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint,
+                    dict(requests=0, bytesIn=0, bytesOut=0))
+            stats['requests'] += 1
+            stats['bytesIn'] += received
+            stats['bytesOut'] += sent
+
+    def takeStats(self):
+        """Returns and resets the per endpoint statistics: requests, bytesIn
+        (request bodies) and bytesOut (response bodies)."""
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+            return stats
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def cookie(self, name):
+        cookies = SimpleCookie(self.headers.get('Cookie', ""))
+        return cookies[name].value if name in cookies else None
+
+    def send(self, code, body=b"", headers=(), endpoint=None, received=0):
+        # counted before anything is sent (end_headers() flushes a bodyless
+        # response), so the client can't see the response before it is
+        self.server.roster.count(endpoint or "other", received, len(body))
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def redirect(self, location, headers=(), endpoint=None, received=0):
+        self.send(302, headers=[("Location", location)] + list(headers),
+                endpoint=endpoint, received=received)
+
+    def readBody(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def acceptsGzip(self):
+        return self.server.roster.gzip and "gzip" in \
+                self.headers.get('Accept-Encoding', "").lower()
+
+    def loggedIn(self, path, endpoint, received=0):
+        """Whether the request has a live session; if not, redirects to
+        the login page."""
+        if self.server.roster.useSession(self.cookie('sessionid')):
+            return True
+        self.redirect("%s?%s" % (self.server.roster.loginLocation,
+            urlencode(dict(next=path))), endpoint=endpoint,
+            received=received)
+        return False
+
+    def do_GET(self):
+        roster = self.server.roster
+        time.sleep(roster.latency)
+        path = urlsplit(self.path).path
+        if path == roster.loginLocation:
+            token = self.cookie('csrftoken') or uuid.uuid4().hex
+            self.send(200, LOGIN_PAGE, [("Content-Type", "text/html"),
+                ("Set-Cookie", "csrftoken=%s; Path=/" % token)], "login")
+        elif not path.startswith(roster.base):
+            self.send(404, b"Not found")
+        elif path == roster.personListLocation:
+            if not self.loggedIn(path, "person_list"):
+                return
+            if roster.shouldFail(roster.failRate):
+                self.send(500, b"Server error (injected)",
+                        endpoint="person_list")
+            elif self.headers.get('If-None-Match') == roster.etag:
+                self.send(304, endpoint="person_list")
+            elif self.acceptsGzip():
+                self.send(200, roster.personListGzip, [("Content-Type",
+                    "text/csv; charset=utf-8"), ("Content-Encoding", "gzip"),
+                    ("ETag", roster.etag), ("Vary", "Accept-Encoding")],
+                    "person_list")
+            else:
+                self.send(200, roster.personList, [("Content-Type",
+                    "text/csv; charset=utf-8"), ("ETag", roster.etag)],
+                    "person_list")
+        elif path.startswith(roster.photoLocation):
+            if not self.loggedIn(path, "photo"):
+                return
+            photo = roster.photo(path[len(roster.photoLocation):])
+            if roster.shouldFail(roster.failRate):
+                self.send(500, b"Server error (injected)", endpoint="photo")
+            elif photo is None:
+                self.send(404, b"No such photo", endpoint="photo")
+            else:
+                self.send(200, photo, [("Content-Type", "image/jpeg")],
+                        "photo")
+        else:
+            if not self.loggedIn(path, "other"):
+                return
+            self.send(200, b"<html><body>Roster</body></html>",
+                    [("Content-Type", "text/html")])
+
+    def do_POST(self):
+        roster = self.server.roster
+        time.sleep(roster.latency)
+        path = urlsplit(self.path).path
+        data = self.readBody()
+        if path == roster.loginLocation:
+            form = dict(parse_qsl(data.decode('utf-8')))
+            token = self.cookie('csrftoken')
+            if token is None or form.get('csrfmiddlewaretoken') != token:
+                self.send(403, b"CSRF verification failed", endpoint="login",
+                        received=len(data))
+            elif form.get('password') != PASSWORD:
+                self.send(200, LOGIN_PAGE, [("Content-Type", "text/html")],
+                        "login", len(data))
+            else:
+                self.redirect(form.get('next') or roster.base,
+                        [("Set-Cookie", "sessionid=%s; Path=/" %
+                            roster.newSession())], "login", len(data))
+        elif path == roster.bulkAddLocation:
+            if not self.loggedIn(path, "bulk_add", len(data)):
+                return
+            if roster.shouldFail(roster.failRate):
+                self.send(500, b"Server error (injected)",
+                        endpoint="bulk_add", received=len(data))
+                return
+            body = data
+            if self.headers.get('Content-Encoding', "").lower() == "gzip":
+                if not roster.gzip:
+                    self.send(415, b"Unsupported Content-Encoding",
+                            endpoint="bulk_add", received=len(data))
+                    return
+                body = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+            self.send(200, roster.addRecords(body),
+                    [("Content-Type", "text/plain; charset=utf-8")],
+                    "bulk_add", len(data))
+        else:
+            self.send(404, b"Not found", received=len(data))
+
+class RosterServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, roster, address=("127.0.0.1", 0), verbose=False):
+        HTTPServer.__init__(self, address, Handler)
+        self.roster = roster
+        self.verbose = verbose
+
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def start(self):
+        """Serve on a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def addArguments(parser):
+    """Roster options shared with loadtest.py."""
+    parser.add_argument("--people", type=int, default=100,
+            help="roster size (default %(default)s)")
+    parser.add_argument("--photo-size", type=int, default=20000,
+            help="bytes per photo (default %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+            help="seconds added to every request")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+            help="fraction of requests answered with a 500 error")
+    parser.add_argument("--reject-rate", type=float, default=0.0,
+            help="fraction of uploaded time records rejected")
+    parser.add_argument("--session-requests", type=int, default=0,
+            help="requests before a session expires (default no limit)")
+    parser.add_argument("--no-gzip", dest="gzip", action="store_false",
+            help="don't compress downloads or accept compressed uploads")
+
+def rosterFromArguments(args):
+    return Roster(people=args.people, photoSize=args.photo_size,
+            latency=args.latency, failRate=args.fail_rate,
+            rejectRate=args.reject_rate,
+            sessionRequests=args.session_requests, gzip=args.gzip)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="log each request")
+    addArguments(parser)
+    args = parser.parse_args()
+
+    server = RosterServer(rosterFromArguments(args), ("127.0.0.1", args.port),
+            args.verbose)
+    print("Serving %d people on %s" % (args.people, server.url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Import scans from a scanner log into the data store.
+
+A scanner log has one scan per line: a date/time and the badge scanned
+(the number or the Code39 barcode as read), separated by a comma, tab or
+semicolon, in either order.  Blank lines and lines starting with # are
+ignored.  Run in the kiosk's directory; the kiosk picks up the imported
+scans when it next touches the store:
+
+    python scanlog.py handheld.txt
+"""
+from __future__ import print_function
+import argparse
+import re
+from datetime import datetime
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+import datastore
+
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M",
+        "%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M", "%Y%m%d%H%M%S")
+
+SEPARATOR = re.compile(r"[,;\t]")
+
+class TimeParser(object):
+    """Parses date/times in any of TIME_FORMATS, trying the format that
+    last worked first (a log normally uses just one)."""
+
+    def __init__(self):
+        self.formats = list(TIME_FORMATS)
+
+    def __call__(self, text):
+        text = text.split(".")[0] # drop fractional seconds
+        for i, format in enumerate(self.formats):
+            try:
+                value = datetime.strptime(text, format)
+            except ValueError:
+                continue
+            if i:
+                self.formats.insert(0, self.formats.pop(i))
+            return value
+        raise ValueError("Unrecognized date/time '%s'" % text)
+
+def readEvents(lines):
+    """Parse scanner log lines.  Returns (events, errors): events is a
+    list of (line number, time, badge text) sorted by time (scans with the
+    same time keep their order), errors a list of (line number, message)
+    for lines that couldn't be parsed."""
+    parseTime = TimeParser()
+    events = []
+    errors = []
+    for number, line in enumerate(lines, 1):
+        # only the line ending is removed: a barcode's checksum may be a
+        # trailing space
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.startswith("#"):
+            continue
+        fields = SEPARATOR.split(line)
+        if len(fields) != 2:
+            errors.append((number, "Expected a date/time and a badge"))
+            continue
+        try:
+            when = parseTime(fields[0].strip())
+            badge = fields[1].lstrip()
+        except ValueError:
+            try:
+                when = parseTime(fields[1].strip())
+                badge = fields[0].lstrip()
+            except ValueError as e:
+                errors.append((number, str(e)))
+                continue
+        events.append((number, when, badge))
+    events.sort(key=lambda event: event[1])
+    return events, errors
+
+def importFile(store, filename):
+    """Apply the scans in a scanner log.  Returns (applied, errors), errors
+    being a list of (line number, message) sorted by line."""
+    with open(filename) as f:
+        events, errors = readEvents(f)
+    results = store.applyEvents([(when, badge)
+        for number, when, badge in events])
+    applied = 0
+    for (number, when, badge), result in zip(events, results):
+        if result[4] is None:
+            applied += 1
+        else:
+            errors.append((number, result[4]))
+    errors.sort()
+    return applied, errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("filename", nargs="+", help="scanner log")
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read("settings.ini")
+    store = datastore.fromConfig(config, None)
+    store.load()
+    for filename in args.filename:
+        applied, errors = importFile(store, filename)
+        for number, message in errors:
+            print("%s:%d: %s" % (filename, number, message))
+        print("%s: %d scans imported, %d skipped" %
+                (filename, applied, len(errors)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import threading
+
+class BoundSignal(object):
+    def __init__(self):
+        self.slots = []
+        self.lock = threading.Lock()
+
+    def connect(self, slot):
+        with self.lock:
+            self.slots = self.slots + [slot]
+
+    def disconnect(self, slot=None):
+        with self.lock:
+            if slot is None:
+                self.slots = []
+            else:
+                self.slots = [s for s in self.slots if s != slot]
+
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+class Signal(object):
+    """Qt-free stand-in for pyqtSignal, so the data store can be used
+    without PyQt.  Declared the same way as a class attribute; slots are
+    called directly on the emitting thread (the GUI re-emits through real
+    Qt signals to get them onto its own thread)."""
+
+    def __init__(self, *types):
+        self.types = types
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        bound = obj.__dict__.get(self)
+        if bound is None:
+            bound = obj.__dict__.setdefault(self, BoundSignal())
+        return bound
@@ -9,6 +9,28 @@ import datastore
 import importlib
 from passworddlg import PasswordDlg
 from finddlg import FindDlg
+from reportdlg import ReportDlg
+import scanlog
+from metrics import metrics
+from models import parseBadge
+from presence import PresenceModel, PresenceView
+from thumbnails import ThumbnailCache
+
+class DataStoreSignals(QObject):
+    """Re-emits the signals of a DataStore as Qt signals, so that slots
+    connected to them are queued to the thread this object lives in."""
+    statusUpdate = pyqtSignal(str)
+    statsChanged = pyqtSignal(object)
+    peopleUpdated = pyqtSignal(list)
+    recordsChanged = pyqtSignal(list)
+    photoUpdated = pyqtSignal(str)
+    reloaded = pyqtSignal()
+
+    def __init__(self, datastore, parent=None):
+        super(DataStoreSignals, self).__init__(parent)
+        for name in ('statusUpdate', 'statsChanged', 'peopleUpdated',
+                'recordsChanged', 'photoUpdated', 'reloaded'):
+            getattr(datastore, name).connect(getattr(self, name).emit)
 
 class Synchronizer(QObject):
     finished = pyqtSignal()
@@ -23,11 +45,38 @@ class Synchronizer(QObject):
         self.datastore.save()
         self.finished.emit()
 
+class Scanner(QObject):
+    """Applies badge scans on its own thread.  Scans queued while a batch
+    is being persisted are applied together as the next batch, so a burst
+    of scans costs one journal write per batch rather than per scan."""
+    # list of (badge, person, record, signedIn) from signInOutMany, emitted
+    # once the batch is durable
+    committed = pyqtSignal(list)
+
+    def __init__(self, datastore, parent=None):
+        super(Scanner, self).__init__(parent)
+        self.datastore = datastore
+        self.pending = []
+
+    @pyqtSlot()
+    def process(self):
+        if not self.pending:
+            return
+        badges, self.pending = self.pending, []
+        self.committed.emit(self.datastore.signInOutMany(badges))
+
+    @pyqtSlot(int)
+    def scan(self, badge):
+        if not self.pending:
+            QTimer.singleShot(0, self.process)
+        self.pending.append(badge)
+
 class ImageLoader(QObject):
     loaded = pyqtSignal(str, QImage)
 
-    def __init__(self, parent=None):
+    def __init__(self, thumbnails, parent=None):
         super(ImageLoader, self).__init__(parent)
+        self.thumbnails = thumbnails
         self.pending = {}
 
     @pyqtSlot()
@@ -36,105 +85,21 @@ class ImageLoader(QObject):
             return
         filename, (width, height) = self.pending.popitem()
         #print("loading %s" % filename)
-        image = QImage(filename)
-        if image.isNull():
-            return
-        image = image.scaled(width, height,
-                Qt.KeepAspectRatioByExpanding,
-                Qt.SmoothTransformation)
-        self.loaded.emit(filename, image)
+        with metrics.timer("image_load_seconds"):
+            image = self.thumbnails.load(filename, width, height)
+        if not image.isNull():
+            self.loaded.emit(filename, image)
 
         if self.pending:
             # keep loading images
             QTimer.singleShot(0, self.doLoadImage)
 
-    @pyqtSlot(dict)
-    def load(self, toload):
-        if not self.pending:
-            QTimer.singleShot(0, self.doLoadImage)
-        self.pending = toload
-
     @pyqtSlot(str, int, int)
     def loadOne(self, filename, width, height):
         if not self.pending:
             QTimer.singleShot(0, self.doLoadImage)
         self.pending[str(filename)] = (width, height)
 
-class PersonImage(QWidget):
-    noImage = QImage("photos/NO-IMAGE-AVAILABLE.jpg")
-
-    def __init__(self, parent=None):
-        super(PersonImage, self).__init__(parent)
-        self.image = None
-        self.pixmap = None
-        self.record = None
-        self.label = QLabel(self)
-        self.label.setAlignment(Qt.AlignCenter)
-        self.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum)
-        self.labelHeight = self.label.minimumSizeHint().height() * 1.25
-
-    def minimumSizeHint(self):
-        return QSize(60, 100)
-
-    def getPixmapSize(self):
-        width = self.size().width()
-        height = self.size().height() - self.labelHeight
-        return (width, height)
-
-    def getPlaceholderPixmap(self):
-        width, height = self.getPixmapSize()
-        return QPixmap.fromImage(self.noImage.scaled(width, height,
-                Qt.KeepAspectRatioByExpanding,
-                Qt.SmoothTransformation))
-
-    def resizeEvent(self, event=None):
-        self.label.move(0, self.size().height()-self.labelHeight)
-        self.label.resize(self.size().width(), self.labelHeight)
-
-    def paintEvent(self, event=None):
-        p = QPainter(self)
-        p.save()
-        p.fillRect(p.viewport(), Qt.white)
-        p.setPen(Qt.black)
-        p.drawRect(p.viewport().adjusted(0, 0, -1, -1))
-        p.restore()
-
-        if self.pixmap is not None:
-            width = p.viewport().width()
-            height = p.viewport().height() - self.labelHeight
-            p.drawPixmap(0, 0, self.pixmap,
-                    abs(width - self.pixmap.width()) / 2,
-                    abs(height - self.pixmap.height()) / 2,
-                    width, height)
-
-    def set(self, record):
-        self.record = record
-        self.image = record.person.photo
-        self.pixmap = self.getPlaceholderPixmap()
-        self.label.setText("%s (%d)" % (
-            record.person.name.partition(' ')[0], record.person.badge))
-        self.update()
-
-    def clear(self):
-        self.record = None
-        self.image = None
-        self.pixmap = None
-        self.label.clear()
-        self.update()
-
-class PersonLabel(QLabel):
-    def __init__(self, parent=None):
-        super(PersonLabel, self).__init__(parent)
-        self.record = None
-
-    def set(self, record):
-        self.record = record
-        self.setText(str(record.person))
-
-    def clear(self):
-        super(PersonLabel, self).clear()
-        self.record = None
-
 class MainWindow(QMainWindow):
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
@@ -149,10 +114,18 @@ class MainWindow(QMainWindow):
         self.backend = backend_module.Backend(self.config)
 
         # Create data store
-        self.datastore = datastore.DataStore(self.backend)
-        self.datastore.statusUpdate.connect(
+        self.datastore = datastore.fromConfig(self.config, self.backend)
+        # DataStore signals are emitted on whichever thread made the
+        # change; connect through Qt signals to get them on this thread
+        self.signals = DataStoreSignals(self.datastore, self)
+        self.signals.statusUpdate.connect(
                 lambda s: self.statusBar().showMessage(s))
-        self.ids = {} # map from id to widget displaying that id
+        self.signals.recordsChanged.connect(self.recordsChanged)
+        # people needing their display refreshed after the current sync
+        self.updatedIds = set()
+        self.signals.peopleUpdated.connect(self.peopleUpdated)
+        # the store was changed by another process (e.g. syncd.py)
+        self.signals.reloaded.connect(self.reconcile)
 
         # Synchronizer thread
         self.synchronizerThread = QThread()
@@ -161,16 +134,28 @@ class MainWindow(QMainWindow):
         self.synchronizer.moveToThread(self.synchronizerThread)
         self.synchronizerThread.start()
 
-        # Pixmap loader thread
-        self.imageWidget = {}
-        self.imageLoaderThread = QThread()
-        self.imageLoader = ImageLoader()
-        self.imageLoader.loaded.connect(self.pixmapLoaded)
-        self.imageLoader.moveToThread(self.imageLoaderThread)
-        self.imageLoaderThread.start()
-
-        self.resizeTimer = QTimer(self)
-        self.resizeTimer.timeout.connect(self.loadPixmaps)
+        # Scanner thread; badge scans are queued to it
+        self.scannerThread = QThread()
+        self.scanner = Scanner(self.datastore)
+        self.scanner.committed.connect(self.scansCommitted)
+        self.scanner.moveToThread(self.scannerThread)
+        self.scannerThread.start()
+
+        # Pixmap loader threads, sharing a cache of scaled photos.  New
+        # photos get thumbnails made on the sync thread that fetched them.
+        self.thumbnails = ThumbnailCache(self.config.getint('global',
+            'THUMBNAIL_CACHE_MB') * 1024 * 1024)
+        self.datastore.photoUpdated.connect(self.thumbnails.update)
+        self.imageLoaders = []
+        self.imageLoaderThreads = []
+        for i in range(self.config.getint('global', 'IMAGE_LOADER_THREADS')):
+            thread = QThread()
+            loader = ImageLoader(self.thumbnails)
+            loader.loaded.connect(self.pixmapLoaded)
+            loader.moveToThread(thread)
+            thread.start()
+            self.imageLoaders.append(loader)
+            self.imageLoaderThreads.append(thread)
 
         # Center widget
         center = QWidget()
@@ -178,45 +163,35 @@ class MainWindow(QMainWindow):
         layout = QGridLayout()
         layout.setSpacing(4)
 
-        self.studentpics = [PersonImage() for i in range(7*4)]
-        self.adultpics = [PersonImage() for i in range(3*4)]
-        self.overflow = [PersonLabel() for i in range(20)]
+        # Presence board; scrolls if more people are in than fit
+        self.students = PresenceModel(self.datastore.photoFile, self)
+        self.adults = PresenceModel(self.datastore.photoFile, self)
+        self.studentView = PresenceView(self.students, 7)
+        self.adultView = PresenceView(self.adults, 3)
+        for view in (self.studentView, self.adultView):
+            view.pixmapNeeded.connect(self.loadPixmap)
 
-        # Photos
         studentlabel = QLabel("Students")
         studentlabel.setAlignment(Qt.AlignCenter)
         studentlabel.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Fixed)
         studentlabel.setObjectName("student")
-        layout.addWidget(studentlabel, 0, 0, 1, 7)
+        layout.addWidget(studentlabel, 0, 0)
 
         adultlabel = QLabel("Mentors & Parents")
         adultlabel.setAlignment(Qt.AlignCenter)
         adultlabel.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Fixed)
         adultlabel.setObjectName("adult")
-        layout.addWidget(adultlabel, 0, 8, 1, 3)
-
-        for row in range(4):
-            for col in range(7):
-                layout.addWidget(self.studentpics[row*7+col], row+1, col)
-                layout.setColumnStretch(col, 1)
-            for col in range(3):
-                layout.addWidget(self.adultpics[row*3+col], row+1, col+8)
-                layout.setColumnStretch(col+8, 1)
-            layout.setRowStretch(row+1, 1)
-
-        # Overflow (including entry text box)
+        layout.addWidget(adultlabel, 0, 2)
+
         self.badgeEdit = QLineEdit()
         self.badgeEdit.returnPressed.connect(self.badgeEntered)
-        layout.addWidget(self.badgeEdit, 0, 7)
+        layout.addWidget(self.badgeEdit, 0, 1)
 
-        overflowwidget = QWidget()
-        overflowlayout = QVBoxLayout()
-        for widget in self.overflow:
-            overflowlayout.addWidget(widget)
-        overflowlayout.addStretch(1)
-        overflowlayout.addStrut(120)
-        overflowwidget.setLayout(overflowlayout)
-        layout.addWidget(overflowwidget, 1, 7, -1, 1)
+        layout.addWidget(self.studentView, 1, 0, 1, 2)
+        layout.addWidget(self.adultView, 1, 2)
+        layout.setColumnStretch(0, 7)
+        layout.setColumnStretch(2, 3)
+        layout.setRowStretch(1, 1)
 
         center.setLayout(layout)
 
@@ -232,6 +207,14 @@ class MainWindow(QMainWindow):
                 tip="Clear all users (no hours credit given)")
         usersClearAllAction.triggered.connect(self.clearAll)
 
+        usersImportScansAction = self.createAction("&Import Scans...",
+                tip="Sign in/out from a scanner log")
+        usersImportScansAction.triggered.connect(self.importScans)
+
+        reportsHoursAction = self.createAction("&Hours...",
+                tip="Total hours by person, day or week")
+        reportsHoursAction.triggered.connect(self.hoursReport)
+
         self.serverPasswordAction = self.createAction("Set &Password...",
                 tip="Set server password")
         self.serverPasswordAction.triggered.connect(self.setServerPassword)
@@ -251,6 +234,13 @@ class MainWindow(QMainWindow):
         actionMenu = self.menuBar().addMenu("&Actions")
         actionMenu.addAction(usersSignOutAllAction)
         actionMenu.addAction(usersClearAllAction)
+        actionMenu.addSeparator()
+        actionMenu.addAction(usersImportScansAction)
+
+        reportsMenu = self.menuBar().addMenu("&Reports")
+        reportsMenu.addAction(reportsHoursAction)
+        reportsHoursAction.setEnabled(self.config.get('global', 'BACKEND')
+                == "csv")
 
         serverMenu = self.menuBar().addMenu("&Server")
         if hasattr(self.backend, 'setPassword'):
@@ -266,7 +256,17 @@ class MainWindow(QMainWindow):
         status.addPermanentWidget(self.numClockedInLabel)
         self.numTimeEntriesLabel = QLabel("0 records")
         status.addPermanentWidget(self.numTimeEntriesLabel)
-        self.datastore.statsChanged.connect(self.statsChanged)
+        self.signals.statsChanged.connect(self.statsChanged)
+        self.metricsLabel = QLabel("")
+        status.addPermanentWidget(self.metricsLabel)
+
+        # Periodically write metrics for diagnosing slowdowns
+        self.metricsFile = self.config.get('global', 'METRICS_FILE')
+        self.metricsTimer = QTimer(self)
+        self.metricsTimer.setInterval(self.config.getint('global',
+            'METRICS_INTERVAL')*1000)
+        self.metricsTimer.timeout.connect(self.writeMetrics)
+        self.metricsTimer.start()
 
         self.setWindowTitle("Sign In Application")
         self.badgeEdit.setFocus()
@@ -296,87 +296,51 @@ class MainWindow(QMainWindow):
 
     def load(self):
         self.datastore.load()
-        for record in self.datastore.clockedIn.values():
+        with self.datastore.locked():
+            records = list(self.datastore.clockedIn.values())
+        for record in records:
             self.signin(record)
         # try to do an initial synchronization on startup
         self.sync()
 
     def badgeEntered(self):
-        badgestr = self.badgeEdit.text()
+        badgestr = str(self.badgeEdit.text())
         self.badgeEdit.clear()
 
-        if badgestr[0] == 'B':
-            # Handle as Code39-encoded barcode "BxxxxC" (C=checksum)
-            # Check checksum across all characters
-            charset = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ-. $/+%"
-            checksum = charset[sum(charset.index(c) for c in badgestr[:-1]) % 43]
-            if checksum != badgestr[-1]:
-                self.statusBar().showMessage("Bad barcode checksum for '%s': expected %s" % (badgestr, checksum))
-                return
-            # Extract internal data (should be number)
-            badgestr = badgestr[1:-1]
-
         try:
-            badge = int(badgestr)
-        except ValueError:
-            self.statusBar().showMessage("Invalid data entry '%s'" % badgestr)
+            badge = parseBadge(badgestr)
+        except ValueError as e:
+            self.statusBar().showMessage(str(e))
             return
 
         self.signInOut(badge)
 
     def signInOut(self, badge):
-        try:
-            record = self.datastore.signInOut(badge)
-        except KeyError:
-            self.statusBar().showMessage("User %d does not exist" % badge)
-            return
-
-        self.statusBar().showMessage("%s signed %s" %
-                (self.datastore.people[self.datastore.badgeToId[badge]],
-                "out" if record is None else "in"))
-
-        if record is not None:
-            self.signin(record)
+        # the display is updated by recordsChanged once the scan is durable
+        QMetaObject.invokeMethod(self.scanner, 'scan', Qt.QueuedConnection,
+                                 Q_ARG(int, badge))
+
+    def scansCommitted(self, results):
+        for badge, person, record, signedIn in results:
+            if person is None:
+                self.statusBar().showMessage("User %d does not exist" % badge)
+            elif signedIn:
+                self.statusBar().showMessage("%s signed in" % person)
+            else:
+                self.statusBar().showMessage("%s signed out" % person)
 
     def signin(self, record):
-        # get notified when person signs out
-        record.completed.connect(self.handle_signout)
-
-        # figure out which widget to place person at..
-        widget = None
+        if record.person.student:
+            self.students.add(record)
+        else:
+            self.adults.add(record)
 
-        # if picture available, try to place in pics
-        person = record.person
-        if person.hasPhoto():
-            if person.student:
-                picwidgets = self.studentpics
-            else:
-                picwidgets = self.adultpics
-            for w in picwidgets:
-                if w.record is None:
-                    widget = w
-                    break
-            if widget is not None:
-                widget.set(record)
-                width, height = widget.getPixmapSize()
-                QMetaObject.invokeMethod(self.imageLoader, 'loadOne',
-                                         Qt.QueuedConnection,
-                                         Q_ARG(str, widget.image),
-                                         Q_ARG(int, width),
-                                         Q_ARG(int, height))
-                self.imageWidget[str(widget.image)] = widget
-
-        # otherwise place in overflow
-        if widget is None:
-            for w in self.overflow:
-                if w.record is None:
-                    widget = w
-                    break
-            if widget is not None:
-                widget.set(record)
-
-        # update widget
-        self.ids[person.id] = widget
+    def loadPixmap(self, filename, width, height):
+        QMetaObject.invokeMethod(self.imageLoaderFor(filename), 'loadOne',
+                                 Qt.QueuedConnection,
+                                 Q_ARG(str, filename),
+                                 Q_ARG(int, width),
+                                 Q_ARG(int, height))
 
     def findUser(self):
         form = FindDlg(self.datastore, parent=self)
@@ -398,6 +362,34 @@ class MainWindow(QMainWindow):
         if reply == QMessageBox.Yes:
             self.datastore.clearAll()
 
+    def importScans(self):
+        filename = QFileDialog.getOpenFileName(self, "Import Scans", "",
+                "Scanner logs (*.txt *.csv *.log);;All files (*)")
+        if not filename:
+            return
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            applied, errors = scanlog.importFile(self.datastore,
+                    str(filename))
+        except IOError as e:
+            QApplication.restoreOverrideCursor()
+            QMessageBox.warning(self, "Import Scans",
+                    "Unable to read %s: %s" % (filename, e))
+            return
+        QApplication.restoreOverrideCursor()
+        message = "%d scans imported, %d skipped" % (applied, len(errors))
+        self.statusBar().showMessage(message)
+        if errors:
+            lines = ["Line %d: %s" % error for error in errors[:20]]
+            if len(errors) > 20:
+                lines.append("...")
+            QMessageBox.warning(self, "Import Scans",
+                    message + "\n\n" + "\n".join(lines))
+
+    def hoursReport(self):
+        form = ReportDlg(self.config.get('csv', 'RECORDS_FILE'), parent=self)
+        form.exec_()
+
     def setServerPassword(self):
         form = PasswordDlg(self)
         if form.exec_():
@@ -413,12 +405,52 @@ class MainWindow(QMainWindow):
     def syncDone(self):
         self.serverPasswordAction.setEnabled(True)
         self.serverSyncAction.setEnabled(True)
-        # update all widgets
-        for id in self.ids:
-            self.ids[id].clear()
-        self.ids.clear()
-        for record in self.datastore.clockedIn.values():
-            self.signin(record)
+        self.reconcile()
+
+    def reconcile(self):
+        # Reconcile the display with who is clocked in; only people who
+        # changed (or whose photo is now a different file) are redrawn.
+        # Records are matched by person and sign in time, as reloading the
+        # store (e.g. after syncd's checkpoint) makes new objects for the
+        # same records.  The store changes on other threads; work from a
+        # copy.
+        with self.datastore.locked():
+            clockedIn = dict(self.datastore.clockedIn)
+        for model in (self.students, self.adults):
+            for record in list(model.records):
+                id = record.person.id
+                current = clockedIn.get(id)
+                if current is None or current.inTime != record.inTime or \
+                        current.person.student != (model is self.students):
+                    model.remove(id)
+                    continue
+                changed = (current.person.name, current.person.badge) != \
+                        (record.person.name, record.person.badge)
+                if current is not record:
+                    model.replace(current)
+                if changed or id in self.updatedIds or model.photos[id] != \
+                        self.datastore.photoFile(current.person):
+                    model.refresh(id)
+        for id, record in clockedIn.items():
+            if id not in self.students and id not in self.adults:
+                self.signin(record)
+        self.updatedIds.clear()
+
+    def recordsChanged(self, ids):
+        # people signed in, out or cleared by one store operation: update
+        # each section of the board in one go
+        with self.datastore.locked():
+            clockedIn = self.datastore.clockedIn
+            records = [clockedIn[id] for id in ids if id in clockedIn]
+        self.students.removeMany(ids)
+        self.adults.removeMany(ids)
+        self.students.addMany([record for record in records
+                if record.person.student])
+        self.adults.addMany([record for record in records
+                if not record.person.student])
+
+    def peopleUpdated(self, ids):
+        self.updatedIds.update(ids)
 
     def autoSyncToggled(self):
         if self.autoSyncAction.isChecked():
@@ -426,54 +458,34 @@ class MainWindow(QMainWindow):
         else:
             self.autoSyncTimer.stop()
 
-    def statsChanged(self):
-        self.numPeopleLabel.setText("%d total" % self.datastore.getNumPeople())
-        self.numClockedInLabel.setText("%d in" % self.datastore.getNumClockedIn())
-        self.numTimeEntriesLabel.setText("%d records" % self.datastore.getNumTimeEntries())
-
-    def handle_signout(self):
-        id = self.sender().person.id
-        if id not in self.ids:
-            return # shouldn't happen, but just in case..
-        if self.ids[id] is not None:
-            self.ids[id].clear()
-        del self.ids[id]
-
-    def resizeEvent(self, event=None):
-        super(MainWindow, self).resizeEvent(event)
-        noPixmap = self.studentpics[0].getPlaceholderPixmap()
-        for pi in self.studentpics:
-            if pi.image is not None:
-                pi.pixmap = noPixmap
-        for pi in self.adultpics:
-            if pi.image is not None:
-                pi.pixmap = noPixmap
-        self.resizeTimer.start(100)
-
-    def loadPixmaps(self):
-        self.resizeTimer.stop()
-        allpics = []
-        allpics.extend(self.studentpics)
-        allpics.extend(self.adultpics)
-
-        toload = {}
-        for pi in allpics:
-            if pi.image is None:
-                continue
-            toload[pi.image] = pi.getPixmapSize()
-            self.imageWidget[str(pi.image)] = pi
-
-        QMetaObject.invokeMethod(self.imageLoader, 'load', Qt.QueuedConnection,
-                                 Q_ARG(dict, toload))
+    def statsChanged(self, stats):
+        self.numPeopleLabel.setText("%d total" % stats.people)
+        self.numClockedInLabel.setText("%d in" % stats.clockedIn)
+        self.numTimeEntriesLabel.setText("%d records" % stats.timeEntries)
+
+    def writeMetrics(self):
+        self.metricsLabel.setText(metrics.summary())
+        if self.metricsFile:
+            try:
+                metrics.write(self.metricsFile)
+            except (IOError, OSError) as e:
+                self.statusBar().showMessage("Could not write metrics: %s" % e)
+
+    def imageLoaderFor(self, filename):
+        # always use the same loader for a file so it's only loaded once
+        return self.imageLoaders[hash(str(filename)) % len(self.imageLoaders)]
 
     @pyqtSlot(str, QImage)
     def pixmapLoaded(self, filename, image):
-        widget = self.imageWidget[str(filename)]
-        widget.pixmap = QPixmap.fromImage(image)
-        widget.update()
+        self.studentView.setPixmap(filename, image)
+        self.adultView.setPixmap(filename, image)
 
     def closeEvent(self, event):
+        # apply any scans still queued before the final save
+        QMetaObject.invokeMethod(self.scanner, 'process',
+                                 Qt.BlockingQueuedConnection)
         self.datastore.save()
+        self.writeMetrics()
 
 if __name__ == "__main__":
     import sys
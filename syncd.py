@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Synchronize the data store with the backend without the GUI.
+
+Runs in the kiosk's directory against the same data store, syncing every
+AUTO_SYNC_TIME seconds (or just once with --once, e.g. from cron).  Photo
+downloads and time record uploads then happen here instead of competing
+with the kiosk; the kiosk picks up the changes when it next touches the
+store.  Doesn't need PyQt.
+"""
+from __future__ import print_function
+import argparse
+import getpass
+import importlib
+import os
+import sys
+import time
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+import datastore
+from metrics import metrics
+
+def log(message):
+    print("%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message))
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--once", action="store_true",
+            help="sync once and exit")
+    parser.add_argument("--interval", type=int,
+            help="seconds between syncs (default AUTO_SYNC_TIME)")
+    parser.add_argument("--metrics",
+            help="write metrics to this file after each sync")
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read("settings.ini")
+    interval = args.interval or config.getint('global', 'AUTO_SYNC_TIME')
+
+    backend_module = importlib.import_module("backend_%s" %
+            config.get('global', 'BACKEND'))
+    backend = backend_module.Backend(config)
+    if hasattr(backend, 'setPassword') and \
+            not config.get('roster', 'LOGIN_PASSWORD'):
+        password = os.environ.get('SIGNIN_LOGIN_PASSWORD')
+        if password is None:
+            if not sys.stdin.isatty():
+                parser.error("set LOGIN_PASSWORD in settings.ini or the "
+                        "SIGNIN_LOGIN_PASSWORD environment variable")
+            password = getpass.getpass("Password: ")
+        backend.setPassword(password)
+
+    store = datastore.fromConfig(config, backend)
+    store.statusUpdate.connect(log)
+    store.load()
+    while True:
+        store.sync()
+        if args.metrics:
+            metrics.write(args.metrics)
+        if args.once:
+            break
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,103 @@
+"""Scans made while a sync is pushing time records mustn't wait for it.
+
+Runs without a display or PyQt:
+
+    python -m unittest test_sync
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import datastore
+from benchmark import Quiet, addTimeLog
+from models import Person
+
+# Slowest acceptable scan while an upload is stalled (seconds); a scan that
+# waits for the upload takes at least STALL
+SCAN_LIMIT = 0.25
+STALL = 2.0
+
+class StalledBackend(object):
+    """Backend whose time record upload blocks until released (or STALL
+    has passed), standing in for a sync stuck on a slow network."""
+
+    def __init__(self, people):
+        self.people = people
+        self.uploading = threading.Event()
+        self.release = threading.Event()
+
+    def getPersonListIfChanged(self, version):
+        if version == 1:
+            return None, version
+        return self.people, 1
+
+    def putTimeRecords(self, records):
+        self.uploading.set()
+        self.release.wait(STALL)
+        return set(range(len(records)))
+
+class ScanDuringSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.scratch = tempfile.mkdtemp(prefix="signintest")
+        os.chdir(self.scratch)
+        os.mkdir("photos")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def checkScans(self, storage):
+        config = ConfigParser()
+        config.read(os.path.join(HERE, "settings.ini"))
+        config.set('global', 'STORAGE', storage)
+        config.set('global', 'UPLOAD_CONCURRENCY', "1")
+        people = [Person(id, "Person %d" % id, True, "", 0, id)
+                for id in range(1, 201)]
+        backend = StalledBackend(people)
+        store = datastore.fromConfig(config, backend)
+        store.load()
+        store.updatePeople(people, 1)
+        addTimeLog(store, 50, random.Random(294))
+
+        thread = threading.Thread(target=store.sync)
+        thread.start()
+        try:
+            self.assertTrue(backend.uploading.wait(10),
+                    "sync never started uploading")
+            times = []
+            for person in people[:50]:
+                start = time.time()
+                store.signInOut(person.badge)
+                times.append(time.time() - start)
+        finally:
+            backend.release.set()
+            thread.join()
+        self.assertLess(max(times), SCAN_LIMIT,
+                "scan took %.3fs during sync" % max(times))
+        # the scans were recorded; the pushed records were acknowledged
+        self.assertEqual(store.getNumClockedIn(), 50)
+        self.assertEqual(store.getNumTimeEntries(), 0)
+
+    def testPickle(self):
+        with Quiet():
+            self.checkScans("pickle")
+
+    def testSqlite(self):
+        with Quiet():
+            self.checkScans("sqlite")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import threading
+from collections import OrderedDict
+from PyQt4.QtCore import Qt, QBuffer, QByteArray, QIODevice
+from PyQt4.QtGui import QImage
+from fileutil import atomicWrite
+from metrics import metrics
+
+THUMBNAIL_DIR = "photos/thumbs"
+# Thumbnails are scaled to fit in a square of this many pixels
+THUMBNAIL_SIZE = 400
+
+def thumbnailPath(photo):
+    return os.path.join(THUMBNAIL_DIR, os.path.basename(photo))
+
+def makeThumbnail(photo, image=None):
+    """Write pre-scaled thumbnail of photo (optionally already loaded as
+    image) to the thumbnail directory."""
+    if image is None:
+        image = QImage(photo)
+    if image.isNull():
+        return
+    if image.width() > THUMBNAIL_SIZE or image.height() > THUMBNAIL_SIZE:
+        image = image.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE,
+                Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, "JPG", 90)
+    buf.close()
+    if not os.path.isdir(THUMBNAIL_DIR):
+        try:
+            os.makedirs(THUMBNAIL_DIR)
+        except OSError:
+            pass # created by another thread
+    with atomicWrite(thumbnailPath(photo)) as f:
+        f.write(bytes(data))
+
+class ThumbnailCache(object):
+    """Two level cache of scaled photos: an in-memory LRU of images keyed by
+    (file, width, height) limited to maxBytes, backed by pre-scaled
+    thumbnails on disk.  Safe to use from several threads."""
+
+    def __init__(self, maxBytes=64*1024*1024):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is not None:
+                self.images[key] = image # now most recently used
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            old = self.images.pop(key, None)
+            if old is not None:
+                self.bytes -= old.byteCount()
+            self.images[key] = image
+            self.bytes += image.byteCount()
+            while self.bytes > self.maxBytes and len(self.images) > 1:
+                self.bytes -= self.images.popitem(last=False)[1].byteCount()
+
+    def update(self, photo):
+        """Make the thumbnail for a newly downloaded photo.  Can be
+        connected directly to DataStore.photoUpdated.  Photos are stored by
+        content, so an existing thumbnail for the file is still valid."""
+        if not os.path.exists(thumbnailPath(photo)):
+            makeThumbnail(photo)
+
+    def source(self, photo, width, height):
+        """Load the smallest image photo can be scaled from to the given
+        size: the on-disk thumbnail if it is current and big enough,
+        otherwise the photo itself (creating the thumbnail from it)."""
+        thumb = thumbnailPath(photo)
+        try:
+            fresh = os.stat(thumb).st_mtime >= os.stat(photo).st_mtime
+        except OSError:
+            fresh = False
+        if fresh:
+            image = QImage(thumb)
+            if not image.isNull() and image.width() >= width and \
+                    image.height() >= height:
+                return image
+        image = QImage(photo)
+        if not fresh:
+            makeThumbnail(photo, image)
+        return image
+
+    def load(self, photo, width, height):
+        """Returns photo scaled to cover width x height, or a null image
+        if photo can't be read."""
+        key = (photo, width, height)
+        image = self.get(key)
+        if image is not None:
+            metrics.count("thumbnail_cache_hits_total")
+            return image
+        metrics.count("thumbnail_cache_misses_total")
+        image = self.source(photo, width, height)
+        if image.isNull():
+            return image
+        image = image.scaled(width, height,
+                Qt.KeepAspectRatioByExpanding,
+                Qt.SmoothTransformation)
+        self.put(key, image)
+        return image
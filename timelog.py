@@ -0,0 +1,267 @@
+import bisect
+import os
+import pickle
+import struct
+import zlib
+from array import array
+from models import *
+
+TIMELOG_DIR = "DataStore.timelog"
+# Maximum number of records in a segment file
+SEGMENT_RECORDS = 1000
+
+# Entries in the journal and segment files are pickles prefixed by their
+# length and CRC32, so that a torn write at the end of a file can be
+# detected and discarded.
+ENTRY_HEADER = struct.Struct("<II")
+
+def writeEntries(f, entries):
+    """Append entries to f.  Returns number of bytes written."""
+    size = 0
+    for entry in entries:
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        f.write(ENTRY_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        f.write(data)
+        size += ENTRY_HEADER.size + len(data)
+    return size
+
+def readEntry(f):
+    """Read one entry.  Returns (entry, offset after entry), or (None, None)
+    at end of file or on a torn entry."""
+    header = f.read(ENTRY_HEADER.size)
+    if len(header) != ENTRY_HEADER.size:
+        return None, None
+    length, crc = ENTRY_HEADER.unpack(header)
+    data = f.read(length)
+    if len(data) != length or zlib.crc32(data) & 0xffffffff != crc:
+        return None, None
+    return pickle.loads(data), f.tell()
+
+class Segment(object):
+    """Records first to first+count-1, stored in the first size bytes of
+    the segment's file."""
+    __slots__ = ('first', 'count', 'size')
+
+    def __init__(self, first, count=0, size=0):
+        self.first = first
+        self.count = count
+        self.size = size
+
+    def filename(self):
+        return os.path.join(TIMELOG_DIR, "%010d.seg" % self.first)
+
+    def seqs(self):
+        return range(self.first, self.first + self.count)
+
+    def __contains__(self, seq):
+        return self.first <= seq < self.first + self.count
+
+class TimeLog(object):
+    """List-like log of completed time records not yet pushed to the
+    backend.  Records are numbered in the order they were added.  Those
+    added since the last checkpoint are held in memory (the tail; they are
+    also in the journal); flush() appends them to segment files on disk.
+    A segment is deleted once all its records have been acknowledged, so
+    neither memory use nor checkpoint cost grows with the backlog."""
+
+    def __init__(self, store):
+        self.store = store
+        self.segments = []
+        self.acked = set() # acknowledged numbers of records in segments
+        self.tail = [] # (number, record)
+        self.nextSeq = 0
+        self.cache = None # (segment first, {number: row}) last read
+
+    def __len__(self):
+        return sum(segment.count for segment in self.segments) - \
+                len(self.acked) + len(self.tail)
+
+    def __bool__(self):
+        return bool(self.tail) or len(self) > 0
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self.pending())
+
+    def append(self, record):
+        self.tail.append((self.nextSeq, record))
+        self.nextSeq += 1
+
+    def state(self):
+        """What a snapshot needs to record (the tail must be flushed
+        first)."""
+        assert not self.tail
+        return dict(segments=[(s.first, s.count, s.size)
+                    for s in self.segments],
+                acked=sorted(self.acked), nextSeq=self.nextSeq)
+
+    def setState(self, state):
+        """Restore the log as of a snapshot (None for an empty log).
+        Segment files not (or no longer) described by it, i.e. written by
+        a checkpoint that didn't complete, are truncated or removed."""
+        self.segments = []
+        self.acked = set()
+        self.tail = []
+        self.nextSeq = 0
+        self.cache = None
+        if state is not None:
+            self.nextSeq = state['nextSeq']
+            self.acked = set(state['acked'])
+            for first, count, size in state['segments']:
+                segment = Segment(first, count, size)
+                try:
+                    if os.path.getsize(segment.filename()) > size:
+                        with open(segment.filename(), "r+b") as f:
+                            f.truncate(size)
+                except OSError:
+                    # deleted once fully acknowledged
+                    self.acked.difference_update(segment.seqs())
+                    continue
+                self.segments.append(segment)
+        known = set(os.path.basename(s.filename()) for s in self.segments)
+        if os.path.isdir(TIMELOG_DIR):
+            for name in os.listdir(TIMELOG_DIR):
+                if name.endswith(".seg") and name not in known:
+                    os.remove(os.path.join(TIMELOG_DIR, name))
+
+    def flush(self):
+        """Durably append the tail to the segment files."""
+        if not self.tail:
+            return
+        if not os.path.isdir(TIMELOG_DIR):
+            os.makedirs(TIMELOG_DIR)
+        self.cache = None
+        while self.tail:
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.count >= SEGMENT_RECORDS or \
+                    segment.first + segment.count != self.tail[0][0]:
+                segment = Segment(self.tail[0][0])
+                self.segments.append(segment)
+            chunk = self.tail[:SEGMENT_RECORDS - segment.count]
+            with open(segment.filename(), "ab") as f:
+                size = writeEntries(f, [(seq, r.person.id, r.inTime,
+                        r.outTime, r.hours, r.recorded) for seq, r in chunk])
+                f.flush()
+                os.fsync(f.fileno())
+            segment.count += len(chunk)
+            segment.size += size
+            del self.tail[:len(chunk)]
+
+    def pending(self):
+        """Returns a TimeLogView of the records not yet acknowledged."""
+        seqs = array('l')
+        for segment in self.segments:
+            seqs.extend(seq for seq in segment.seqs()
+                    if seq not in self.acked)
+        seqs.extend(seq for seq, record in self.tail)
+        return TimeLogView(self, seqs)
+
+    def acknowledge(self, seqs):
+        """Mark records as pushed, deleting segments that are now fully
+        acknowledged."""
+        seqs = set(seqs)
+        self.tail = [(seq, r) for seq, r in self.tail if seq not in seqs]
+        firsts = [segment.first for segment in self.segments]
+        touched = set()
+        for seq in seqs:
+            i = bisect.bisect_right(firsts, seq) - 1
+            if i >= 0 and seq in self.segments[i]:
+                self.acked.add(seq)
+                touched.add(i)
+        for i in sorted(touched, reverse=True):
+            segment = self.segments[i]
+            if all(seq in self.acked for seq in segment.seqs()):
+                try:
+                    os.remove(segment.filename())
+                except OSError:
+                    pass # already removed by another process
+                self.acked.difference_update(segment.seqs())
+                del self.segments[i]
+                if self.cache is not None and self.cache[0] == segment.first:
+                    self.cache = None
+
+    def removeKeys(self, keys):
+        """Remove records by (person id, sign in time), as acknowledged in
+        journals written before the log was segmented.  Such records are
+        always in the tail."""
+        keys = set(keys)
+        self.tail = [(seq, r) for seq, r in self.tail
+                if (r.person.id, r.inTime) not in keys]
+
+    def readSegment(self, segment):
+        if self.cache is not None and self.cache[0] == segment.first:
+            return self.cache[1]
+        rows = {}
+        try:
+            with open(segment.filename(), "rb") as f:
+                while f.tell() < segment.size:
+                    row, offset = readEntry(f)
+                    if row is None:
+                        break
+                    rows[row[0]] = row
+        except IOError:
+            pass
+        self.cache = (segment.first, rows)
+        return rows
+
+    def load(self, seqs):
+        """Returns list of (seq, record) for the records numbered seqs
+        (skipping any that have since been acknowledged or can't be
+        read)."""
+        with self.store.locked():
+            tail = dict(self.tail)
+            firsts = [segment.first for segment in self.segments]
+            people = self.store.people
+            records = []
+            for seq in seqs:
+                record = tail.get(seq)
+                if record is None:
+                    if seq in self.acked:
+                        continue
+                    i = bisect.bisect_right(firsts, seq) - 1
+                    row = None
+                    if i >= 0:
+                        row = self.readSegment(self.segments[i]).get(seq)
+                    if row is None:
+                        continue
+                    seq, personId, inTime, outTime, hours, recorded = row
+                    person = people.get(personId)
+                    if person is None:
+                        # no longer on the roster; only the id is sent anyway
+                        person = Person(personId, "", True, "", 0, 0)
+                    record = TimeRecord(person, inTime)
+                    record.outTime = outTime
+                    record.hours = hours
+                    record.recorded = recorded
+                records.append((seq, record))
+            return records
+
+class TimeLogView(object):
+    """Fixed sequence of time records, identified by number.  Records are
+    only read from the segment files while being iterated."""
+
+    def __init__(self, log, seqs):
+        self.log = log
+        self.seqs = seqs
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TimeLogView(self.log, self.seqs[index])
+        return self.log.load([self.seqs[index]])[0][1]
+
+    def __iter__(self):
+        for start in range(0, len(self.seqs), SEGMENT_RECORDS):
+            for seq, record in self.log.load(
+                    self.seqs[start:start+SEGMENT_RECORDS]):
+                yield record
+
+    def loaded(self):
+        """Read the records.  Returns (view of just those that could be
+        read, list of them), so that indices into the list identify the
+        records in the view."""
+        pairs = self.log.load(self.seqs)
+        return (TimeLogView(self.log, [seq for seq, record in pairs]),
+                [record for seq, record in pairs])
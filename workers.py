@@ -0,0 +1,49 @@
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def runConcurrently(func, items, workers):
+    """Call func(item) for each item on a pool of up to workers threads.
+    Yields (item, result, exception) tuples in order of completion;
+    exception is None if func returned normally.
+
+    items is consumed lazily on the calling thread, with at most workers
+    items in flight at once, so producing the next item overlaps with
+    processing the previous ones."""
+    if hasattr(items, '__len__'):
+        workers = min(workers, len(items))
+    workers = max(1, workers)
+    todo = queue.Queue()
+    done = queue.Queue()
+
+    def work():
+        while True:
+            item = todo.get()
+            if item is todo:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception as e:
+                done.put((item, None, e))
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        inflight = 0
+        for item in items:
+            todo.put(item)
+            inflight += 1
+            if inflight >= workers:
+                yield done.get()
+                inflight -= 1
+        while inflight:
+            yield done.get()
+            inflight -= 1
+    finally:
+        # the queue itself is used as the sentinel telling workers to exit
+        for thread in threads:
+            todo.put(todo)